@@ -17,20 +17,38 @@ def chunk(word: str, size: int) -> Generator:
 
 
 class NGramModel:
+    """
+    Counts of the character following each context of size - 1 characters.
+
+    Only contexts that occur in the training words get a row in N, so memory
+    grows with the corpus rather than as |V|^(size-1). A context is stored as
+    an integer, its characters read as base-|V| digits, and `contexts` holds
+    the sorted ids of the seen ones: row i of N counts what follows
+    contexts[i].
+    """
+
     def __init__(self, size: int, special_char: str = "."):
         self.size = size
         self.special_char = special_char
         self.lbl = "".join([self.special_char] * (self.size - 1))
         self.stoi = None
         self.itos = None
+        self.contexts = None
         self.N = None
 
-    def encode(self, text: str) -> int:
-        return self.stoi[text]
+    def encode(self, text: str) -> torch.Tensor:
+        return torch.tensor([self.stoi[c] for c in text], dtype=torch.long)
 
     def decode(self, i: int) -> str:
         return self.itos[i]
 
+    def decode_context(self, context_id: int) -> str:
+        chars = []
+        for _ in range(self.size - 1):
+            context_id, i = divmod(context_id, len(self.itos))
+            chars.append(self.itos[i])
+        return "".join(reversed(chars))
+
     def corpus(self, words):
         chars = set("".join(words))
         chars.add(self.special_char)
@@ -43,43 +61,55 @@ class NGramModel:
         stoi = {s: idx for idx, s in itos.items()}
         return x_terms, y_terms, all_dim, itos, stoi
 
+    def ngrams(self, words: List[str]) -> torch.Tensor:
+        """
+        Every n-gram of the padded words, as in chunk(), one encoded row each
+        """
+        # The padding that ends one word also starts the next, so the words
+        # can be joined and slid over in one go
+        text = self.lbl + self.lbl.join(words) + self.lbl
+        return self.encode(text).unfold(0, self.size, 1)
+
+    def context_ids(self, contexts: torch.Tensor) -> torch.Tensor:
+        powers = len(self.itos) ** torch.arange(self.size - 2, -1, -1)
+        return (contexts * powers).sum(1)
+
+    def rows(self, context_ids: torch.Tensor) -> torch.Tensor:
+        """
+        Row of N for each context id, -1 for contexts not seen in training
+        """
+        rows = torch.searchsorted(self.contexts, context_ids)
+        rows = rows.clamp(max=len(self.contexts) - 1)
+        return torch.where(self.contexts[rows] == context_ids, rows, -1)
+
     def train(self, words: List[str], print_graph: bool = False):
-        x_terms, y_terms, all_dim, itos, stoi = self.corpus(words)
-        x_dim = len(x_terms)
-        y_dim = len(y_terms)
+        chars = set("".join(words))
+        chars.add(self.special_char)
+        self.itos = {idx: s for idx, s in enumerate(sorted(chars))}
+        self.stoi = {s: idx for idx, s in self.itos.items()}
+        y_dim = len(self.itos)
 
         # build frequency mapping
-        ngram_to_count = dict()
-        for word in words:
-            word = self.lbl + word + self.lbl
-            for x, y in chunk(word, self.size):
-                ngram_to_count[(x, y)] = ngram_to_count.get((x, y), 0) + 1
-
-        N = torch.zeros((all_dim, all_dim))
-        for (x, y), count in ngram_to_count.items():
-            N[stoi[x], stoi[y]] = count
+        ngrams = self.ngrams(words)
+        self.contexts, rows = torch.unique(
+            self.context_ids(ngrams[:, :-1]), return_inverse=True
+        )
+        x_dim = len(self.contexts)
+        counts = torch.bincount(rows * y_dim + ngrams[:, -1], minlength=x_dim * y_dim)
+        N = counts.view(x_dim, y_dim).float()
         self.N = N
-        self.itos = itos
-        self.stoi = stoi
 
         if print_graph:
-            itox = {idx: s for idx, s in enumerate(x_terms)}
-            itoy = {idx: s for idx, s in enumerate(y_terms)}
-
             mpl.rcParams["font.size"] = 4
             scale = 1
             fig, ax = plt.subplots(figsize=(y_dim * scale, x_dim * scale))
-            A = N[:y_dim, x_dim:]
-            ax.imshow(A, cmap="Blues")
+            ax.imshow(N, cmap="Blues")
             for i in range(x_dim):
+                context = self.decode_context(self.contexts[i].item())
                 for j in range(y_dim):
-                    chstr = itox[i] + itoy[j]
-                    _x = stoi[itox[i]]
-                    _y = stoi[itoy[j]]
+                    chstr = context + self.itos[j]
                     plt.text(j, i, chstr, ha="center", va="bottom", color="gray")
-                    plt.text(
-                        j, i, N[_x, _y].item(), ha="center", va="top", color="gray"
-                    )
+                    plt.text(j, i, N[i, j].item(), ha="center", va="top", color="gray")
             ax.axis("off")
             fig.tight_layout(pad=0)
             fig.savefig("figure.png", dpi=300)
@@ -92,7 +122,8 @@ class NGramModel:
         for _ in range(number_samples):
             s = self.lbl
             while True:
-                idx = self.stoi[s[-self.size + 1 :]]
+                context = self.encode(s[-self.size + 1 :]).unsqueeze(0)
+                idx = self.rows(self.context_ids(context)).item()
                 cidx = torch.multinomial(
                     P[idx], num_samples=1, replacement=True, generator=g
                 ).item()
@@ -105,13 +136,13 @@ class NGramModel:
     def loss(self, words: List[str]) -> float:
         P = self.N.float()
         P /= P.sum(1, keepdim=True)
-        ll = 0
-        for word in words:
-            word = self.lbl + word + self.lbl
-            for x, y in chunk(word, self.size):
-                prob = P[self.encode(x), self.encode(y)]
-                logprob = torch.log(prob)
-                ll += logprob
+        ngrams = self.ngrams(words)
+        rows = self.rows(self.context_ids(ngrams[:, :-1]))
+        # An unseen context has probability 0, like an unseen character
+        seen = rows >= 0
+        prob = torch.zeros(len(ngrams))
+        prob[seen] = P[rows[seen], ngrams[seen, -1]]
+        ll = torch.log(prob).sum()
         return -ll
 
 
@@ -213,6 +244,7 @@ def main():
     models = [
         ("ngram2", NGramModel(2, special_char="#")),
         ("ngram3", NGramModel(3, special_char="#")),
+        ("ngram5", NGramModel(5, special_char="#")),
         ("ngram3_nn", NGramModelNN(3, special_char="#")),
     ]
     for model_name, model in models:
@@ -0,0 +1,188 @@
+"""Benchmarks for the micrograd engine in ugrad.py.
+
+    python bench_ugrad.py gradcheck ops throughput
+
+`gradcheck` compares the gradients of each op and of an MLP loss with finite differences, and
+exits with an error if any disagree. Run it before trusting the numbers of a faster engine.
+
+`ops` times the forward and backward pass of a single node of each op.
+
+`throughput` reports the nodes per second built and backpropagated through for the example
+graphs and for MLP losses of growing width.
+
+`memory` builds a few large graphs under tracemalloc and reports the bytes allocated and the
+time taken per graph node.
+"""
+
+import argparse
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from ugrad import BACKWARD, MLP, Value, decreasing_graph, gradcheck, layered_graph, topological_sort
+
+
+def layered(width, depth):
+    """Like `layered_graph`, but of any size: each node is the sum of the whole previous layer"""
+    layer = [Value(float(np.random.uniform(-1.0, 1.0))) for _ in range(width)]
+    for _ in range(depth - 1):
+        layer = [sum(layer) for _ in range(width)]
+    return sum(layer)
+
+
+def mlp_loss(num_inputs, layer_sizes, num_samples):
+    """The squared error loss of a fresh MLP over random samples, as built by the training loop"""
+    m = MLP(num_inputs, layer_sizes)
+    xs = np.random.uniform(-0.5, 0.5, (num_samples, num_inputs)).tolist()
+    ys = np.random.uniform(-0.5, 0.5, num_samples).tolist()
+    return sum((m(x) - y) ** 2 for x, y in zip(xs, ys))
+
+
+GRAPHS = {
+    "layered 30x30": lambda: layered(30, 30),
+    "mlp 1-5-4-3-1 x100": lambda: mlp_loss(1, [5, 4, 3, 1], 100),
+    "mlp 16-32-32-1 x20": lambda: mlp_loss(16, [32, 32, 1], 20),
+}
+
+
+def measure_memory(build):
+    """Build a graph twice: once timed, once under tracemalloc (which slows allocation down).
+
+    Returns (nodes, bytes per node, microseconds per node).
+    """
+    start = time.perf_counter()
+    build()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    root = build()
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes = len(topological_sort(root))
+    return nodes, allocated / nodes, seconds / nodes * 1e6
+
+
+def bench_memory():
+    print(f"{'graph':<22} {'nodes':>8} {'bytes/node':>11} {'us/node':>8}")
+    for name, build in GRAPHS.items():
+        nodes, per_node, us = measure_memory(build)
+        print(f"{name:<22} {nodes:>8} {per_node:>11.0f} {us:>8.2f}")
+
+
+def best_time(fn, number):
+    """Seconds per call of `fn`, best of 5 runs of `number` calls"""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number
+
+
+# name: fn(a, b) building one node of the op
+OPS = {
+    "+": lambda a, b: a + b,
+    "x": lambda a, b: a * b,
+    "**": lambda a, b: a**3,
+    "tanh": lambda a, b: a.tanh(),
+}
+
+
+def gradcheck_cases():
+    """name: (fn, inputs) for gradcheck"""
+    a, b = Value(0.3), Value(-0.7)
+    cases = {name: (lambda op=op: op(a, b), [a, b]) for name, op in OPS.items()}
+
+    weights = [Value(w) for w in np.random.uniform(-1.0, 1.0, 4)]
+    xs = [Value(x) for x in np.random.uniform(-1.0, 1.0, 4)]
+    bias = Value(0.1)
+    cases["dot"] = (lambda: Value.dot(weights, xs, bias), [bias, *weights, *xs])
+
+    m = MLP(3, [4, 4, 1])
+    samples = np.random.uniform(-1.0, 1.0, (5, 3)).tolist()
+    ys = np.random.uniform(-1.0, 1.0, 5).tolist()
+    cases["mlp 3-4-4-1 x5"] = (
+        lambda: sum((m(x) - y) ** 2 for x, y in zip(samples, ys)),
+        m.parameters(),
+    )
+    return cases
+
+
+def bench_gradcheck():
+    print(f"{'graph':<22} {'inputs':>7} {'max abs error':>14}")
+    failed = []
+    for name, (fn, inputs) in gradcheck_cases().items():
+        analytic, numeric = gradcheck(fn, inputs)
+        error = max(abs(x - y) for x, y in zip(analytic, numeric))
+        ok = np.allclose(analytic, numeric, rtol=1e-4, atol=1e-6)
+        print(f"{name:<22} {len(inputs):>7} {error:>14.2e}{'' if ok else '  FAIL'}")
+        if not ok:
+            failed.append(name)
+    if failed:
+        raise SystemExit(f"gradcheck failed for: {', '.join(failed)}")
+
+
+def bench_ops():
+    print(f"{'op':<6} {'forward ns':>11} {'backward ns':>12}")
+    a, b = Value(0.3), Value(-0.7)
+    for name, op in OPS.items():
+        node = op(a, b)
+        backward = BACKWARD[node.op]
+        forward_ns = best_time(lambda: op(a, b), 100_000) * 1e9
+        backward_ns = best_time(lambda: backward(node), 100_000) * 1e9
+        print(f"{name:<6} {forward_ns:>11.0f} {backward_ns:>12.0f}")
+
+
+# name: a function building a graph and returning its root
+THROUGHPUT_GRAPHS = {
+    # decreasing_graph also runs backward as it builds
+    "decreasing_graph": lambda: decreasing_graph()[-1][-1],
+    "layered_graph": lambda: layered_graph()[-1][-1],
+    **{
+        f"mlp 4-{w}-{w}-1 x10": (lambda w=w: mlp_loss(4, [w, w, 1], 10))
+        for w in (8, 16, 32, 64)
+    },
+}
+
+
+def bench_throughput():
+    print(f"{'graph':<22} {'nodes':>8} {'forward knodes/s':>17} {'backward knodes/s':>18}")
+    for name, build in THROUGHPUT_GRAPHS.items():
+        root = build()
+        nodes = len(topological_sort(root))
+        number = max(1, 20_000 // nodes)
+        forward = best_time(build, number)
+
+        def backward():
+            # Include the topological sort, as a fresh graph's first backward would
+            root._sorted_nodes = None
+            root.backward()
+
+        backward_seconds = best_time(backward, number)
+        print(
+            f"{name:<22} {nodes:>8} {nodes / forward / 1e3:>17.0f}"
+            f" {nodes / backward_seconds / 1e3:>18.0f}"
+        )
+
+
+BENCHMARKS = {
+    "gradcheck": bench_gradcheck,
+    "ops": bench_ops,
+    "throughput": bench_throughput,
+    "memory": bench_memory,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "benchmarks", nargs="*", metavar="benchmark", help=f"any of {', '.join(BENCHMARKS)} (default: all)"
+    )
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    for name, bench in BENCHMARKS.items():
+        if not args.benchmarks or name in args.benchmarks:
+            bench()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import numpy as np
+import pytest
+
+from ugrad import (
+    MLP,
+    BatchMLP,
+    DataParallel,
+    Neuron,
+    Tape,
+    Value,
+    capture,
+    gradcheck,
+    topological_sort,
+    write_dot,
+)
+
+
+def scalar_step(m, xs, ys, learning_rate):
+    ypreds = [m(x) for x in xs]
+    loss = sum((ypred - y) ** 2 for ypred, y in zip(ypreds, ys))
+    for p in m.parameters():
+        p.grad = 0
+    loss.backward()
+    for p in m.parameters():
+        p.data += -learning_rate * p.grad
+    return loss.data
+
+
+def test_batch_mlp_matches_scalar_gradients():
+    m = MLP(3, [4, 4, 1])
+    xs = np.random.uniform(-1.0, 1.0, (20, 3))
+    ys = np.random.uniform(-1.0, 1.0, 20)
+
+    model = BatchMLP.from_mlp(m)
+    assert np.allclose(model.parameters(), [p.data for p in m.parameters()])
+    ypreds = model(xs)
+    assert np.allclose(ypreds[:, 0], [m(list(x)).data for x in xs])
+
+    scalar_step(m, xs.tolist(), ys.tolist(), 0.0)
+    model.zero_grad()
+    model.backward(2 * (ypreds[:, 0] - ys))
+    assert np.allclose(model.grads(), [p.grad for p in m.parameters()])
+
+
+def test_batch_mlp_trains_like_scalar_mlp():
+    m = MLP(1, [5, 4, 3, 1])
+    xs = [[np.random.uniform(-0.5, 0.5)] for _ in range(100)]
+    ys = [x[0] * 0.1 for x in xs]
+
+    model = BatchMLP.from_mlp(m)
+    for _ in range(5):
+        scalar_loss = scalar_step(m, xs, ys, 0.001)
+        ypreds = model(xs)[:, 0]
+        batch_loss = ((ypreds - ys) ** 2).sum()
+        model.zero_grad()
+        model.backward(2 * (ypreds - ys))
+        model.step(0.001)
+        assert np.isclose(batch_loss, scalar_loss)
+    assert np.allclose(model.parameters(), [p.data for p in m.parameters()])
+
+
+def test_value_gradients_with_repeated_operands():
+    a = Value(3.0)
+    b = Value(-2.0)
+    out = (a * a + a * b) ** 2
+    out.backward()
+    # d/da (a^2 + ab)^2 = 2(a^2 + ab)(2a + b), d/db = 2(a^2 + ab)a
+    assert a.grad == 2 * 3.0 * (6.0 - 2.0)
+    assert b.grad == 2 * 3.0 * 3.0
+    assert not hasattr(out, "__dict__")
+
+
+def test_backward_handles_deep_graphs_and_tapes():
+    def build():
+        x = Value(0.5)
+        y = x
+        for _ in range(50_000):
+            y = y * 0.9999 + 0.001
+        return x, y.tanh()
+
+    x, out = build()
+    out.backward()
+
+    with Tape() as tape:
+        x_taped, out_taped = build()
+    assert len(tape.nodes) == 200_002
+    out_taped.backward(tape)
+    assert x_taped.grad == pytest.approx(x.grad)
+    assert x.grad != 0
+
+
+def test_captured_graph_replays_training():
+    m = MLP(2, [4, 3, 1])
+    xs = np.random.uniform(-1.0, 1.0, (10, 2)).tolist()
+    ys = np.random.uniform(-1.0, 1.0, 10).tolist()
+    replayed = MLP(2, [4, 3, 1])
+    for p, q in zip(replayed.parameters(), m.parameters()):
+        p.data = q.data
+
+    def loss(model):
+        return sum((model(x) - y) ** 2 for x, y in zip(xs, ys))
+
+    step = capture(lambda: loss(replayed), replayed.parameters())
+    for _ in range(3):
+        expected = loss(m)
+        for p in m.parameters():
+            p.grad = 0
+        expected.backward()
+        for p in m.parameters():
+            p.data += -0.01 * p.grad
+
+        assert step.forward() == pytest.approx(expected.data)
+        for p in replayed.parameters():
+            p.grad = 0
+        step.backward()
+        for p in replayed.parameters():
+            p.data += -0.01 * p.grad
+
+    for p, q in zip(replayed.parameters(), m.parameters()):
+        assert p.data == pytest.approx(q.data)
+
+
+def test_dot_matches_unfused_expression():
+    ws = [Value(w) for w in np.random.uniform(-1.0, 1.0, 6)]
+    xs = [Value(x) for x in np.random.uniform(-1.0, 1.0, 5)] + [0.25]
+    bias = Value(0.1)
+    fused = Value.dot(ws, xs, bias).tanh()
+    fused.backward()
+    fused_grads = [v.grad for v in ws + xs[:-1] + [bias]]
+
+    for v in ws + xs[:-1] + [bias]:
+        v.grad = 0
+    unfused = sum([w * x for w, x in zip(ws, xs)], bias).tanh()
+    unfused.backward()
+    assert fused.data == unfused.data
+    assert fused_grads == pytest.approx([v.grad for v in ws + xs[:-1] + [bias]])
+
+    step = capture(lambda: Value.dot(ws, xs, bias).tanh(), ws + xs[:-1] + [bias])
+    assert step.forward() == pytest.approx(fused.data)
+
+
+def test_neuron_graph_size_is_constant():
+    for num_inputs in (2, 20, 200):
+        x = [Value(v) for v in np.random.uniform(-1.0, 1.0, num_inputs)]
+        out = Neuron(num_inputs)(x)
+        # tanh -> dot -> bias, weights and inputs
+        assert len(topological_sort(out)) == 2 + 1 + 2 * num_inputs
+        assert out.prev[0].op == "dot"
+
+
+def test_data_parallel_matches_single_process_training():
+    m = MLP(1, [5, 4, 3, 1])
+    xs = [[np.random.uniform(-0.5, 0.5)] for _ in range(30)]
+    ys = [x[0] * 0.1 for x in xs]
+    parallel = MLP(1, [5, 4, 3, 1])
+    for p, q in zip(parallel.parameters(), m.parameters()):
+        p.data = q.data
+
+    with DataParallel(parallel, xs, ys, workers=3) as dp:
+        for _ in range(3):
+            expected = sum((m(x) - y) ** 2 for x, y in zip(xs, ys))
+            for p in m.parameters():
+                p.grad = 0
+            expected.backward()
+            for p in m.parameters():
+                p.data += -0.01 * p.grad
+
+            for p in parallel.parameters():
+                p.grad = 0
+            assert dp.step() == pytest.approx(expected.data)
+            for p in parallel.parameters():
+                p.data += -0.01 * p.grad
+
+    for p, q in zip(parallel.parameters(), m.parameters()):
+        assert p.data == pytest.approx(q.data)
+
+
+def test_write_dot_collapses_neurons_and_caps_depth(tmp_path):
+    m = MLP(2, [3, 1])
+    loss = (m([0.5, -0.5]) - 1.0) ** 2
+    path = tmp_path / "loss.dot"
+
+    # **, +, the constant 1.0, the output neuron, 3 hidden neurons and the 2 inputs
+    assert write_dot(loss, path) == 9
+    text = path.read_text()
+    assert text.startswith("digraph {") and text.endswith("}\n")
+    assert text.count("neuron 3 in") == 1 and text.count("neuron 2 in") == 3
+    assert '"dot"' not in text
+
+    assert write_dot(loss, path, max_depth=2) == 4
+    assert "... 3" in path.read_text()
+
+    assert write_dot(loss, path, collapse_neurons=False) == len(topological_sort(loss))
+
+
+def test_gradcheck_agrees_with_finite_differences():
+    m = MLP(2, [3, 1])
+    xs = [[0.5, -0.5], [0.1, 0.9]]
+    ys = [1.0, -1.0]
+
+    def loss():
+        return sum((m(x) - y) ** 2 for x, y in zip(xs, ys))
+
+    analytic, numeric = gradcheck(loss, m.parameters())
+    assert analytic == pytest.approx(numeric, rel=1e-4, abs=1e-6)
+    assert [p.grad for p in m.parameters()] == analytic
+
+    # A wrong backward is caught
+    a = Value(0.3)
+    analytic, numeric = gradcheck(lambda: a * a * a, [a])
+    assert analytic == pytest.approx(numeric)
+    analytic, numeric = gradcheck(lambda: Value(a.data**3, (a,), "tanh"), [a])
+    assert analytic != pytest.approx(numeric)
+
+
+def test_capture_handles_repeated_inputs_numpy_exponents_and_wide_dots():
+    a, b = Value(3.0), Value(4.0)
+    step = capture(lambda: a * b, [a, a, b])
+    assert step.forward() == 12.0
+    step.backward()
+    assert (a.grad, b.grad) == (4.0, 3.0)
+
+    a.grad = 0
+    step = capture(lambda: a ** np.float64(2), [a])
+    assert step.forward() == 9.0
+    step.backward()
+    assert a.grad == 6.0
+
+    weights = [Value(1.0) for _ in range(3000)]
+    xs = [Value(0.5) for _ in range(3000)]
+    step = capture(lambda: Value.dot(weights, xs, 1.0), weights + xs)
+    assert step.forward() == 1501.0
+    step.backward()
+    assert weights[0].grad == 0.5 and xs[-1].grad == 1.0
+
+
+def test_unknown_ops_have_no_backward():
+    a = Value(2.0)
+    out = Value(1.0, (a,), "custom") * a
+    out.backward()
+    assert (out.grad, a.grad) == (1, 1.0)
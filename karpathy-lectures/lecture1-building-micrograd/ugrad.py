@@ -1,9 +1,9 @@
+import math
+import multiprocessing
+from collections import deque
+
 import numpy as np
 from graphviz import Digraph
-import sys
-
-# Required for topolical sort when the number of neurons + inputs is large
-sys.setrecursionlimit(10000)
 
 # The MLP does not converge quickly during certain runs, because the model params
 # constantly change. Fix the feed, so model convergence is determinstic
@@ -20,6 +20,10 @@ class Value:
           the data of the current/sibling node may be used.
         - The _sorted_nodes list is only populated for the leaf node / final node in the graph.
           Doing a topo sort can be expensive, so we only do it once.
+        - Nodes created inside `with Tape() as tape:` are recorded on the tape, and
+          `backward(tape)` walks the tape instead of sorting the graph.
+        - Graphs get large, so nodes use __slots__, keep their children in a tuple and look up
+          their backward function in BACKWARD by op instead of holding a closure each.
 
 
     Attributes:
@@ -27,11 +31,14 @@ class Value:
         grad (float): The gradient of the node.
         label (str): The label of the node.
         op (str): The operation that generated the node. Can be unary or binary
-        _backward (function): The function that computes the gradient of the node.
+        prev (tuple): The operands of `op`, in order.
+        _exponent (float): The exponent, for nodes produced by `**`.
         _sorted_nodes (list): The list of nodes sorted in the graph topologically.
             Only populated when called on the leaf node.
     """
 
+    __slots__ = ("data", "grad", "label", "op", "prev", "_exponent", "_sorted_nodes")
+
     def __init__(
         self,
         data,
@@ -43,21 +50,15 @@ class Value:
         self.grad = 0
         self.label = label
         self.op = op
-        self.prev = set(_children)
-        self._backward = lambda: None
+        self.prev = _children
+        self._exponent = None
         self._sorted_nodes = None
+        if _tape is not None:
+            _tape.append(self)
 
     def __add__(self, other):
         other = Value(other, op="const") if not isinstance(other, Value) else other
-        new = Value(self.data + other.data, op="+", _children=(self, other))
-
-        def _backward():
-            self.grad += new.grad
-            other.grad += new.grad
-
-        new._backward = _backward
-
-        return new
+        return Value(self.data + other.data, op="+", _children=(self, other))
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -73,61 +74,150 @@ class Value:
 
     def __mul__(self, other):
         other = Value(other, op="const") if not isinstance(other, Value) else other
-        new = Value(self.data * other.data, op="x", _children=(self, other))
-
-        def _backward():
-            self.grad += other.data * new.grad
-            other.grad += self.data * new.grad
-
-        new._backward = _backward
-
-        return new
+        return Value(self.data * other.data, op="x", _children=(self, other))
 
     def __pow__(self, other):
         out = Value(self.data**other, op="**", _children=(self,), label=f"**{other}")
-
-        def _backward():
-            self.grad += out.grad * (other * (self.data ** (other - 1)))
-
-        out._backward = _backward
+        out._exponent = other
         return out
 
     def tanh(self):
-        new = Value(np.tanh(self.data), op="tanh", _children=(self,))
-
-        def _backward():
-            self.grad += (1 - new.data**2) * new.grad
-
-        new._backward = _backward
-
-        return new
-
-    def backward(self):
+        return Value(np.tanh(self.data), op="tanh", _children=(self,))
+
+    @staticmethod
+    def dot(weights, inputs, bias=0.0):
+        """Compute bias + w1 * x1 + w2 * x2 + ... as a single node.
+
+        Equivalent to `sum([w * x for w, x in zip(weights, inputs)], bias)`, which creates two
+        nodes per term in a chain as deep as the inputs are long. The node's children are the
+        bias, then the paired weights, then the paired inputs.
+        """
+        bias = bias if isinstance(bias, Value) else Value(bias, op="const")
+        weights = list(weights)[: len(inputs)]
+        inputs = [x if isinstance(x, Value) else Value(x, op="const") for x in inputs[: len(weights)]]
+        data = bias.data
+        for w, x in zip(weights, inputs):
+            data += w.data * x.data
+        return Value(data, op="dot", _children=(bias, *weights, *inputs))
+
+    def _backward(self):
+        backward = BACKWARD.get(self.op)
+        if backward is not None:
+            backward(self)
+
+    def backward(self, tape=None):
         # Compute the gradients from the leaf node back to the root
         # Assume that graph is a DAG with 1 component
-        if not self._sorted_nodes:
-            self._sorted_nodes = topological_sort(self)
-        sorted_nodes = self._sorted_nodes
+        if tape is not None:
+            # Creation order is already a topological order
+            sorted_nodes = tape.nodes
+        else:
+            if not self._sorted_nodes:
+                self._sorted_nodes = topological_sort(self)
+            sorted_nodes = self._sorted_nodes
         self.grad = 1
         for node in reversed(sorted_nodes):
-            node._backward()
+            backward = BACKWARD.get(node.op)
+            if backward is not None:
+                backward(node)
 
     def __str__(self):
         return f"Value(label={self.label}, data={self.data}, grad={self.grad})"
 
 
+def _add_backward(node):
+    a, b = node.prev
+    a.grad += node.grad
+    b.grad += node.grad
+
+
+def _mul_backward(node):
+    a, b = node.prev
+    a.grad += b.data * node.grad
+    b.grad += a.data * node.grad
+
+
+def _pow_backward(node):
+    (a,) = node.prev
+    exponent = node._exponent
+    a.grad += node.grad * (exponent * (a.data ** (exponent - 1)))
+
+
+def _tanh_backward(node):
+    (a,) = node.prev
+    a.grad += (1 - node.data**2) * node.grad
+
+
+def _dot_backward(node):
+    bias, *rest = node.prev
+    n = len(rest) // 2
+    grad = node.grad
+    bias.grad += grad
+    for w, x in zip(rest[:n], rest[n:]):
+        w.grad += x.data * grad
+        x.grad += w.data * grad
+
+
+# Backward function for each op, called with the node the op produced. Leaves and ops not
+# listed here, such as custom labels, have none.
+BACKWARD = {
+    "": None,
+    "const": None,
+    "+": _add_backward,
+    "x": _mul_backward,
+    "**": _pow_backward,
+    "tanh": _tanh_backward,
+    "dot": _dot_backward,
+}
+
+
+# Nodes of the innermost active Tape, if any
+_tape = None
+
+
+class Tape:
+    """Records every Value created while it is active, in creation order.
+
+    A node is always created after its operands, so the tape is a topological order of the
+    graph and backward can walk it directly:
+
+        with Tape() as tape:
+            loss = sum((m(x) - y) ** 2 for x, y in zip(xs, ys))
+        loss.backward(tape)
+
+    Nodes created on the tape that don't lead to the loss only pass on a zero gradient.
+
+    Attributes:
+        nodes (list): The recorded nodes, oldest first.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self._outer = None
+
+    def __enter__(self):
+        global _tape
+        self._outer = _tape
+        _tape = self.nodes
+        return self
+
+    def __exit__(self, *exc):
+        global _tape
+        _tape = self._outer
+        self._outer = None
+
+
 def trace(root):
     # builds a set of all nodes and edges in a graph
     nodes, edges = set(), set()
-
-    def build(v):
+    stack = [root]
+    while stack:
+        v = stack.pop()
         if v not in nodes:
             nodes.add(v)
             for child in v.prev:
                 edges.add((child, v))
-                build(child)
-
-    build(root)
+                stack.append(child)
     return nodes, edges
 
 
@@ -157,37 +247,240 @@ def draw_dot(root, fname="graph"):
     return dot
 
 
+def _is_neuron(node):
+    """Whether `node` is the tanh(w·x + b) output of a Neuron"""
+    return node.op == "tanh" and node.prev[0].op == "dot"
+
+
+def write_dot(root, fname, max_depth=None, collapse_neurons=True):
+    """Write the graph of `root` as DOT text to `fname`, one node at a time.
+
+    Unlike `draw_dot`, no Digraph is built in memory, so this works for the graph of a full
+    training loss. Render the file with e.g. `dot -Tsvg graph.dot -o graph.svg`.
+
+    Args:
+        max_depth (int): Draw only the nodes this many steps from `root`. A node whose
+            operands are cut off gets a "..." node saying how many there are.
+        collapse_neurons (bool): Draw each tanh(w·x + b) of a Neuron as one "neuron" node
+            connected straight to its inputs, leaving out the dot node, weights and bias.
+
+    Returns:
+        int: The number of Values drawn.
+    """
+    seen = {id(root)}
+    queue = deque([(root, 0)])
+    drawn = 0
+    with open(fname, "w") as f:
+        f.write("digraph {\n\trankdir=LR\n")  # LR = left to right
+        while queue:
+            n, depth = queue.popleft()
+            uid = str(id(n))
+            drawn += 1
+            if collapse_neurons and _is_neuron(n):
+                dot = n.prev[0]
+                # the dot node's children are the bias, the weights, then the inputs
+                children = dot.prev[1 + (len(dot.prev) - 1) // 2 :]
+                title, op = "neuron %d in" % len(children), "neuron"
+            else:
+                children = n.prev
+                title, op = n.label, n.op
+            # for any value in the graph, create a rectangular ('record') node for it
+            f.write(
+                '\t%s [label="{ %s | data %.4f | grad %.4f }" shape=record]\n'
+                % (uid, title, n.data, n.grad)
+            )
+            if not op:
+                continue
+            # if this value is a result of some operation, create an op node for it
+            f.write('\t"%s%s" [label="%s"]\n\t"%s%s" -> %s\n' % (uid, op, op, uid, op, uid))
+            if max_depth is not None and depth >= max_depth:
+                f.write('\t%smore [label="... %d" shape=plaintext]\n' % (uid, len(children)))
+                f.write('\t%smore -> "%s%s"\n' % (uid, uid, op))
+                continue
+            for child in children:
+                # connect the child to the op node of this value
+                f.write('\t%s -> "%s%s"\n' % (id(child), uid, op))
+                if id(child) not in seen:
+                    seen.add(id(child))
+                    queue.append((child, depth + 1))
+        f.write("}\n")
+    return drawn
+
+
 def topological_sort(final_node):
-    # sort nodes in topological order
+    # sort nodes in topological order, children first. Uses an explicit stack rather than
+    # recursion so graphs of any depth can be sorted. Each entry is (node, children_done).
     sorted_nodes = []
     visited = set()
-
-    def visit(node):
-        if node not in visited:
-            visited.add(node)
-            for child in node.prev:
-                visit(child)
+    stack = [(final_node, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if children_done:
             sorted_nodes.append(node)
-
-    visit(final_node)
+        elif node not in visited:
+            visited.add(node)
+            stack.append((node, True))
+            # Reversed so children are visited in order, as a recursive walk would
+            for child in reversed(node.prev):
+                if child not in visited:
+                    stack.append((child, False))
 
     return sorted_nodes
 
 
-a = Value(-0.5, label="a")
-b = Value(0.6, label="b")
-c = a * b
-c.label = "c"
-d = a * c
-d.label = "d"
-e = d * b
-e.label = "e"
-f = e.tanh()
-f.label = "f"
+# Source templates for replaying each op over the data (d) and grad (g) lists of a
+# CapturedGraph. {out} is the node's slot, {a}/{b} its operands' slots and {e} the exponent.
+# For dot, {terms} and {grads} expand to one accumulated product and two gradient updates
+# per input.
+FORWARD_SOURCE = {
+    "+": "d[{out}] = d[{a}] + d[{b}]",
+    "x": "d[{out}] = d[{a}] * d[{b}]",
+    "**": "d[{out}] = d[{a}] ** {e}",
+    "tanh": "d[{out}] = tanh(d[{a}])",
+    "dot": "acc = d[{bias}]\n{terms}\nd[{out}] = acc",
+}
+BACKWARD_SOURCE = {
+    "+": "g[{a}] += g[{out}]\ng[{b}] += g[{out}]",
+    "x": "g[{a}] += d[{b}] * g[{out}]\ng[{b}] += d[{a}] * g[{out}]",
+    "**": "g[{a}] += g[{out}] * ({e} * d[{a}] ** ({e} - 1))",
+    "tanh": "g[{a}] += (1 - d[{out}] ** 2) * g[{out}]",
+    "dot": "g[{bias}] += g[{out}]\ngo = g[{out}]\n{grads}",
+}
+
+
+class CapturedGraph:
+    """A graph recorded once and replayed over flat lists instead of Value objects.
+
+    Every node gets a slot in the preallocated `data` and `grad` lists, and the ops become one
+    straight-line forward function and one backward function, compiled once. A replay reads
+    the current `.data` of the input Values, recomputes every slot and adds the gradients
+    back into the inputs' `.grad`, so the usual update loop over `MLP.parameters()` still
+    works and no Value is created per iteration:
+
+        step = capture(lambda: sum((m(x) - y) ** 2 for x, y in zip(xs, ys)), m.parameters())
+        for it in range(200):
+            loss = step.forward()
+            for p in m.parameters():
+                p.grad = 0
+            step.backward()
+            for p in m.parameters():
+                p.data += -0.001 * p.grad
+
+    The graph must have the same shape on every replay (no branching on data). Leaves that
+    are not inputs, such as constants, keep the value they had when captured. The captured
+    Value objects themselves are not updated; use `value` to read a node's latest data.
+
+    Attributes:
+        inputs (list): The Values whose data is read on every forward pass.
+        output (Value): The node whose gradient is seeded with 1 by backward.
+        data (list): The value of every node, by slot.
+        grad (list): The gradient of every node, by slot.
+    """
+
+    def __init__(self, output, inputs):
+        self.output = output
+        # An input listed twice would otherwise get two positions but one slot
+        self.inputs = list({id(v): v for v in inputs}.values())
+        nodes = topological_sort(output)
+        # Inputs first, so loading them is one slice assignment
+        self.slots = {id(v): i for i, v in enumerate(self.inputs)}
+        next_slot = len(self.slots)
+        for node in nodes:
+            if id(node) not in self.slots:
+                self.slots[id(node)] = next_slot
+                next_slot += 1
+        self.data = [0.0] * len(self.slots)
+        for node in nodes:
+            self.data[self.slots[id(node)]] = float(node.data)
+        self.grad = [0.0] * len(self.slots)
+        self._zeros = [0.0] * len(self.slots)
+        # Keep the nodes alive so their ids stay unique while `slots` refers to them
+        self._nodes = nodes
+
+        forward, backward = [], []
+        for node in nodes:
+            slot = self.slots[id(node)]
+            # Inputs and other leaves are loaded, not computed
+            if slot < len(self.inputs) or node.op not in FORWARD_SOURCE:
+                continue
+            fields = {"out": slot}
+            if node._exponent is not None:
+                # repr of a NumPy scalar isn't valid source, e.g. np.float64(2.0)
+                fields["e"] = repr(float(node._exponent))
+            if node.op == "dot":
+                bias, *rest = [self.slots[id(child)] for child in node.prev]
+                pairs = list(zip(rest[: len(rest) // 2], rest[len(rest) // 2 :]))
+                fields["bias"] = bias
+                # One statement per term: a single long expression overflows the compiler
+                fields["terms"] = "\n".join("acc += d[%d] * d[%d]" % p for p in pairs)
+                fields["grads"] = "\n".join(
+                    "g[%d] += d[%d] * go\ng[%d] += d[%d] * go" % (w, x, x, w) for w, x in pairs
+                )
+            else:
+                for name, child in zip("ab", node.prev):
+                    fields[name] = self.slots[id(child)]
+            forward.append(FORWARD_SOURCE[node.op].format(**fields))
+            backward.append(BACKWARD_SOURCE[node.op].format(**fields))
+        backward.reverse()
+        forward.append("return d[%d]" % self.slots[id(output)])
+        self._forward = _compile_replay("forward", forward)
+        self._backward = _compile_replay("backward", backward)
+
+    def forward(self):
+        """Recompute every node from the inputs' current data. Returns the output's value."""
+        self.data[: len(self.inputs)] = [v.data for v in self.inputs]
+        return self._forward(self.data, self.grad)
+
+    def backward(self):
+        """Backpropagate from the output of the last forward pass into the inputs' grads"""
+        grad = self.grad
+        grad[:] = self._zeros
+        grad[self.slots[id(self.output)]] = 1.0
+        self._backward(self.data, grad)
+        for v, g in zip(self.inputs, grad):
+            v.grad += g
+
+    def value(self, node):
+        """The data of a captured node as of the last forward pass"""
+        return self.data[self.slots[id(node)]]
+
+
+def _compile_replay(name, statements):
+    body = "\n".join(statements).replace("\n", "\n    ")
+    source = "def %s(d, g):\n    %s\n    return None\n" % (name, body or "pass")
+    namespace = {"tanh": math.tanh}
+    exec(compile(source, "<captured %s>" % name, "exec"), namespace)
+    return namespace[name]
 
 
-f.backward()
-draw_dot(f, "toy_graph")
+def capture(fn, inputs):
+    """Run `fn` once to build its graph and return it as a CapturedGraph over `inputs`"""
+    return CapturedGraph(fn(), inputs)
+
+
+def gradcheck(fn, inputs, eps=1e-6):
+    """Compare backward's gradients of `fn()` with central finite differences.
+
+    `fn` must build its graph afresh from `inputs` on every call. The inputs' grads are
+    overwritten with the analytic gradients.
+
+    Returns:
+        tuple: (analytic, numeric), the two gradients of each input as lists.
+    """
+    for v in inputs:
+        v.grad = 0
+    fn().backward()
+    analytic = [v.grad for v in inputs]
+    numeric = []
+    for v in inputs:
+        data = v.data
+        v.data = data + eps
+        above = fn().data
+        v.data = data - eps
+        below = fn().data
+        v.data = data
+        numeric.append((above - below) / (2 * eps))
+    return analytic, numeric
 
 
 def decreasing_graph():
@@ -244,7 +537,7 @@ class Neuron:
         self.bias = Value(np.random.uniform(-1.0, 1.0))
 
     def __call__(self, x):
-        ret = sum([w * x for w, x in zip(self.weights, x)], self.bias)
+        ret = Value.dot(self.weights, x, self.bias)
         ret = ret.tanh()
         return ret
 
@@ -259,6 +552,8 @@ class Layer:
         self.neurons = [Neuron(num_inputs) for _ in range(num_neurons)]
 
     def __call__(self, x):
+        # Wrap plain numbers once here, rather than once per neuron
+        x = [v if isinstance(v, Value) else Value(v, op="const") for v in x]
         outs = [n(x) for n in self.neurons]
         return outs[0] if len(outs) == 1 else outs
 
@@ -285,46 +580,253 @@ class MLP:
         return [p for layer in self.layers for p in layer.parameters()]
 
 
-nds = decreasing_graph()
-draw_dot(nds[-1][-1], "decreasing_graph")
+class BatchMLP:
+    """An MLP with the same architecture as `MLP`, but whose parameters are one weight matrix and one
+    bias vector per layer, so a whole batch of samples goes forward and backward as matrix ops.
+
+    Gradients accumulate like they do for `Value`, so call `zero_grad` before each backward pass:
+
+        model = BatchMLP.from_mlp(m)
+        for it in range(200):
+            ypreds = model(xs)
+            model.zero_grad()
+            model.backward(2 * (ypreds - ys))  # gradient of sum((ypred - y) ** 2)
+            model.step(0.001)
+
+    Attributes:
+        weights (list): One (num_inputs, num_neurons) array per layer.
+        biases (list): One (num_neurons,) array per layer.
+        weight_grads (list): Gradients of the weights, same shapes as `weights`.
+        bias_grads (list): Gradients of the biases, same shapes as `biases`.
+    """
+
+    def __init__(self, number_inputs, layer_sizes):
+        sz = [number_inputs] + layer_sizes
+        self.weights = [
+            np.random.uniform(-1.0, 1.0, (sz[i], sz[i + 1])) for i in range(len(layer_sizes))
+        ]
+        self.biases = [np.random.uniform(-1.0, 1.0, sz[i + 1]) for i in range(len(layer_sizes))]
+        self.weight_grads = [np.zeros_like(w) for w in self.weights]
+        self.bias_grads = [np.zeros_like(b) for b in self.biases]
+        # Input and layer outputs of the last forward pass, needed by backward
+        self._activations = None
+
+    @classmethod
+    def from_mlp(cls, mlp):
+        """Create a BatchMLP holding a copy of the parameters of a scalar `MLP`"""
+        model = cls.__new__(cls)
+        model.weights = [
+            np.array([[w.data for w in n.weights] for n in layer.neurons]).T for layer in mlp.layers
+        ]
+        model.biases = [np.array([n.bias.data for n in layer.neurons]) for layer in mlp.layers]
+        model.weight_grads = [np.zeros_like(w) for w in model.weights]
+        model.bias_grads = [np.zeros_like(b) for b in model.biases]
+        model._activations = None
+        return model
+
+    def __call__(self, xs):
+        """Compute the outputs for a batch of inputs of shape (batch, num_inputs)"""
+        x = np.asarray(xs, dtype=float)
+        activations = [x]
+        for w, b in zip(self.weights, self.biases):
+            x = np.tanh(x @ w + b)
+            activations.append(x)
+        self._activations = activations
+        return x
 
-nds = layered_graph()
-draw_dot(nds[-1][-1], "layered_graph")
+    def backward(self, out_grad):
+        """Accumulate parameter gradients given the gradient of the loss w.r.t. the last outputs.
 
-# MODEL TRAINING
-n = Neuron(10)
-x = [Value(np.random.uniform(-0.5, 0.5)) for _ in range(10)]
+        Returns the gradient w.r.t. the inputs of the batch.
+        """
+        grad = np.asarray(out_grad, dtype=float).reshape(self._activations[-1].shape)
+        for i in reversed(range(len(self.weights))):
+            # Through tanh, then the affine map
+            grad = grad * (1 - self._activations[i + 1] ** 2)
+            self.weight_grads[i] += self._activations[i].T @ grad
+            self.bias_grads[i] += grad.sum(axis=0)
+            grad = grad @ self.weights[i].T
+        return grad
 
-m = MLP(1, [5, 4, 3, 1])
+    def zero_grad(self):
+        for g in self.weight_grads + self.bias_grads:
+            g.fill(0.0)
 
-xs = [
-    [2.0, 3.0, -1.0],
-    [3.0, -1.0, 0.5],
-    [0.5, 1.0, 1.0],
-    [1.0, 1.0, -1.0],
-]
-ys = [1.0, -1.0, -1.0, 1.0]
+    def step(self, learning_rate):
+        for p, g in zip(self.weights + self.biases, self.weight_grads + self.bias_grads):
+            p -= learning_rate * g
 
-xs = [[np.random.uniform(-0.5, 0.5)] for _ in range(100)]
-ys = [x[0] * 0.1 for x in xs]
+    def parameters(self):
+        """Parameters in the same order as `MLP.parameters`: per neuron, its bias then its weights"""
+        return np.concatenate(
+            [np.column_stack([b, w.T]).ravel() for w, b in zip(self.weights, self.biases)]
+        )
 
-for it in range(200):
-    ypreds = [m(x) for x in xs]
-    loss = sum((ypred - y) ** 2 for ypred, y in zip(ypreds, ys))
+    def grads(self):
+        """Gradients in the same order as `parameters`"""
+        return np.concatenate(
+            [np.column_stack([b, w.T]).ravel() for w, b in zip(self.weight_grads, self.bias_grads)]
+        )
 
-    # zero grads before computing them
-    for p in m.parameters():
-        p.grad = 0
-    loss.backward()
 
-    # update parameters
-    for p in m.parameters():
-        p.data += -0.001 * p.grad
+def _squared_error(model, xs, ys):
+    return sum((model(x) - y) ** 2 for x, y in zip(xs, ys))
+
+
+def _data_parallel_worker(conn, model, xs, ys, params, grads, index):
+    """Serve loss/gradient requests for one shard until told to stop"""
+    parameters = model.parameters()
+    params = np.frombuffer(params)
+    row = np.frombuffer(grads).reshape(-1, len(parameters))[index]
+    step = capture(lambda: _squared_error(model, xs, ys), parameters)
+    while conn.recv():
+        for p, data in zip(parameters, params):
+            p.data = float(data)
+        loss = step.forward()
+        for p in parameters:
+            p.grad = 0
+        step.backward()
+        row[:] = [p.grad for p in parameters]
+        conn.send(loss)
+
+
+class DataParallel:
+    """Computes the squared error loss of an MLP and its gradients with the samples split across
+    worker processes, one shard each.
+
+    Each worker keeps its own copy of the model and captures the loss graph of its shard once.
+    Every step, the master's parameter values are published through a shared-memory array,
+    each worker writes its shard's gradients to a shared-memory row of its own, and their sum
+    is added to the master's `.grad`s, so the usual update loop keeps working:
+
+        with DataParallel(m, xs, ys, workers=4) as dp:
+            for it in range(200):
+                for p in m.parameters():
+                    p.grad = 0
+                loss = dp.step()
+                for p in m.parameters():
+                    p.data += -0.001 * p.grad
 
-    print(it, loss.data)
+    Attributes:
+        model (MLP): The master model, whose parameters are read and whose grads are updated.
+        shards (list): (xs, ys) for each worker.
+    """
 
-for it in range(50):
-    new_x = np.random.uniform(-0.5, 0.5)
-    y_expected = new_x * 0.1
-    y_pred = m([new_x])
-    print(f"Input: {new_x}, Expected: {y_expected}, Predicted: {y_pred.data}")
+    def __init__(self, model, xs, ys, workers=None):
+        workers = min(workers or multiprocessing.cpu_count(), len(xs))
+        self.model = model
+        self._parameters = model.parameters()
+        bounds = np.linspace(0, len(xs), workers + 1).astype(int)
+        self.shards = [
+            (list(xs[lo:hi]), list(ys[lo:hi])) for lo, hi in zip(bounds[:-1], bounds[1:])
+        ]
+        size = len(self._parameters)
+        self._params = multiprocessing.RawArray("d", size)
+        self._grads = multiprocessing.RawArray("d", size * workers)
+        self._conns = []
+        self._workers = []
+        for i, (shard_xs, shard_ys) in enumerate(self.shards):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_data_parallel_worker,
+                args=(worker_conn, model, shard_xs, shard_ys, self._params, self._grads, i),
+                daemon=True,
+            )
+            worker.start()
+            self._conns.append(conn)
+            self._workers.append(worker)
+
+    def step(self):
+        """Compute the loss over all samples and add its gradients to the model's grads"""
+        np.frombuffer(self._params)[:] = [p.data for p in self._parameters]
+        for conn in self._conns:
+            conn.send(True)
+        loss = sum(conn.recv() for conn in self._conns)
+        grads = np.frombuffer(self._grads).reshape(len(self.shards), -1).sum(axis=0)
+        for p, g in zip(self._parameters, grads):
+            p.grad += float(g)
+        return loss
+
+    def close(self):
+        for conn in self._conns:
+            conn.send(None)
+        for worker in self._workers:
+            worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    a = Value(-0.5, label="a")
+    b = Value(0.6, label="b")
+    c = a * b
+    c.label = "c"
+    d = a * c
+    d.label = "d"
+    e = d * b
+    e.label = "e"
+    f = e.tanh()
+    f.label = "f"
+
+    f.backward()
+    draw_dot(f, "toy_graph")
+
+    nds = decreasing_graph()
+    draw_dot(nds[-1][-1], "decreasing_graph")
+
+    nds = layered_graph()
+    draw_dot(nds[-1][-1], "layered_graph")
+
+    # MODEL TRAINING
+    n = Neuron(10)
+    x = [Value(np.random.uniform(-0.5, 0.5)) for _ in range(10)]
+
+    m = MLP(1, [5, 4, 3, 1])
+
+    xs = [
+        [2.0, 3.0, -1.0],
+        [3.0, -1.0, 0.5],
+        [0.5, 1.0, 1.0],
+        [1.0, 1.0, -1.0],
+    ]
+    ys = [1.0, -1.0, -1.0, 1.0]
+
+    xs = [[np.random.uniform(-0.5, 0.5)] for _ in range(100)]
+    ys = [x[0] * 0.1 for x in xs]
+
+    def compute_loss():
+        ypreds = [m(x) for x in xs]
+        return sum((ypred - y) ** 2 for ypred, y in zip(ypreds, ys))
+
+    # The loss graph has the same shape every iteration, so build it once and replay it
+    step = capture(compute_loss, m.parameters())
+    for it in range(200):
+        loss = step.forward()
+
+        # zero grads before computing them
+        for p in m.parameters():
+            p.grad = 0
+        step.backward()
+
+        # update parameters
+        for p in m.parameters():
+            p.data += -0.001 * p.grad
+
+        print(it, loss)
+
+    # Too big for draw_dot, so stream it out with each neuron drawn as one node
+    write_dot(compute_loss(), "mlp_loss.dot")
+
+    for it in range(50):
+        new_x = np.random.uniform(-0.5, 0.5)
+        y_expected = new_x * 0.1
+        y_pred = m([new_x])
+        print(f"Input: {new_x}, Expected: {y_expected}, Predicted: {y_pred.data}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+import math
+
+import pytest
+
+from lecture02 import NGramModel, chunk
+
+WORDS = ["emma", "olivia", "ava", "isabella", "sophia"]
+
+
+def chunk_counts(model, words):
+    """The (context, next char) counts of the original chunk() loop"""
+    counts = {}
+    for word in words:
+        word = model.lbl + word + model.lbl
+        for x, y in chunk(word, model.size):
+            counts[(x, y)] = counts.get((x, y), 0) + 1
+    return counts
+
+
+@pytest.mark.parametrize("size", [2, 3])
+def test_counts_and_loss_match_chunk_loop(size):
+    model = NGramModel(size)
+    model.train(WORDS)
+    counts = chunk_counts(model, WORDS)
+
+    assert len(model.contexts) == len({x for x, _ in counts})
+    assert model.N.sum().item() == sum(counts.values())
+    totals = {}
+    expected_loss = 0.0
+    for (x, y), count in counts.items():
+        row = model.rows(model.context_ids(model.encode(x).unsqueeze(0))).item()
+        assert model.N[row, model.stoi[y]].item() == count
+        totals[x] = totals.get(x, 0) + count
+    for (x, y), count in counts.items():
+        expected_loss -= count * math.log(count / totals[x])
+
+    assert model.loss(WORDS).item() == pytest.approx(expected_loss, rel=1e-5)
+
+
+def test_unseen_ngrams_have_infinite_loss():
+    model = NGramModel(3)
+    model.train(WORDS)
+    # "ve" never follows "av"
+    assert model.loss(["ave"]).item() == math.inf
+    # and "ve" is never a context at all
+    assert model.loss(["avea"]).item() == math.inf
+    samples = model.sample(5)
+    assert all(s.startswith(model.lbl) and s.endswith(model.lbl) for s in samples)
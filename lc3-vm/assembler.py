@@ -0,0 +1,362 @@
+"""
+A two-pass LC-3 assembler for the .asm sources in this directory:
+
+    python assembler.py print_ascii.asm -o print_ascii.obj
+
+writes a big-endian .obj image that vm.read_image can load, plus an lc3as
+style .sym symbol table next to it. build() keeps assembled output in a
+cache keyed by a hash of the source, so an unchanged source is only ever
+assembled once. LC3VM.load_image uses it to run .asm files directly.
+"""
+
+from array import array
+from typing import Dict, List, Optional, Tuple
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+
+# Bump when the output for a given source could change, so stale cache entries are ignored
+ASSEMBLER_VERSION = 1
+CACHE_DIR = "__lc3cache__"
+
+OPCODES = {
+    "ADD": 0b0001,
+    "AND": 0b0101,
+    "NOT": 0b1001,
+    "LD": 0b0010,
+    "LDI": 0b1010,
+    "LDR": 0b0110,
+    "LEA": 0b1110,
+    "ST": 0b0011,
+    "STI": 0b1011,
+    "STR": 0b0111,
+    "JMP": 0b1100,
+    "RET": 0b1100,
+    "JSR": 0b0100,
+    "JSRR": 0b0100,
+    "TRAP": 0b1111,
+    "RTI": 0b1000,
+}
+TRAPS = {"GETC": 0x20, "OUT": 0x21, "PUTS": 0x22, "IN": 0x23, "PUTSP": 0x24, "HALT": 0x25}
+DIRECTIVES = {".ORIG", ".FILL", ".BLKW", ".STRINGZ", ".END"}
+BRANCH = re.compile(r"BR(N?Z?P?)$")
+LABEL = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+REGISTER = re.compile(r"R([0-7])$", re.IGNORECASE)
+TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|[^\s,]+')
+ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", '"': '"', "\\": "\\"}
+
+
+class AssemblyError(ValueError):
+    def __init__(self, fname: str, line: int, message: str):
+        super().__init__(f"{fname}:{line}: {message}")
+        self.fname = fname
+        self.line = line
+
+
+def is_mnemonic(token: str) -> bool:
+    token = token.upper()
+    return token in OPCODES or token in TRAPS or token in DIRECTIVES or bool(BRANCH.match(token))
+
+
+def strip_comment(line: str) -> str:
+    """
+    Drops everything after a `;` that isn't inside a string literal
+    """
+    quoted = False
+    escaped = False
+    for i, c in enumerate(line):
+        if escaped:
+            escaped = False
+        elif c == "\\":
+            escaped = quoted
+        elif c == '"':
+            quoted = not quoted
+        elif c == ";" and not quoted:
+            return line[:i]
+    return line
+
+
+def parse_number(token: str) -> Optional[int]:
+    """
+    Parses `#10`, `#-3`, `x3000`, `b101` or a bare decimal. Returns None if
+    `token` isn't a number.
+    """
+    text = token[1:] if token[:1] == "#" else token
+    base = 10
+    if text[:1] in "xXbB" and len(text) > 1 and token[:1] != "#":
+        base = 16 if text[0] in "xX" else 2
+        text = text[1:]
+    try:
+        return int(text, base)
+    except ValueError:
+        return None
+
+
+def parse_string(token: str) -> str:
+    if len(token) < 2 or token[0] != '"' or token[-1] != '"':
+        raise ValueError(f"expected a string literal, got {token}")
+    return re.sub(r"\\(.)", lambda m: ESCAPES.get(m.group(1), m.group(1)), token[1:-1])
+
+
+def tokenize(source: str) -> List[Tuple[int, Optional[str], List[str]]]:
+    """
+    Splits source into (line number, label, [mnemonic, operands...]) per
+    non-empty line
+    """
+    lines = []
+    for number, line in enumerate(source.splitlines(), 1):
+        tokens = TOKEN.findall(strip_comment(line))
+        if not tokens:
+            continue
+        label = None
+        if not is_mnemonic(tokens[0]):
+            label = tokens.pop(0)
+        lines.append((number, label, tokens))
+    return lines
+
+
+def size_of(mnemonic: str, operands: List[str]) -> int:
+    """
+    Number of words a line occupies
+    """
+    if mnemonic == ".BLKW":
+        count = parse_number(operands[0]) if operands else None
+        if count is None or count < 0:
+            raise ValueError(".BLKW needs a non-negative count")
+        return count
+    if mnemonic == ".STRINGZ":
+        if len(operands) != 1:
+            raise ValueError(".STRINGZ needs one string")
+        return len(parse_string(operands[0])) + 1
+    return 1
+
+
+def assemble(source: str, fname: str = "<source>") -> Tuple[int, array, Dict[str, int]]:
+    """
+    Assembles LC-3 source. Returns (origin, words, {label: address}).
+    Raises AssemblyError pointing at the offending line.
+    """
+    lines = tokenize(source)
+
+    # First pass: find .ORIG and give every label an address
+    origin = None
+    symbols: Dict[str, int] = {}
+    program = []
+    address = 0
+    for number, label, tokens in lines:
+        try:
+            mnemonic = tokens[0].upper() if tokens else None
+            if origin is None:
+                if mnemonic != ".ORIG" or label is not None:
+                    raise ValueError("expected .ORIG before anything else")
+                origin = parse_number(tokens[1]) if len(tokens) == 2 else None
+                if origin is None or not 0 <= origin <= 0xFFFF:
+                    raise ValueError(".ORIG needs an address")
+                address = origin
+                continue
+            if label is not None:
+                if not LABEL.match(label) or REGISTER.match(label):
+                    raise ValueError(f"invalid label or unknown instruction {label}")
+                # Later definitions win, as with the assembler main-out.obj came from
+                symbols[label] = address
+            if mnemonic is None:
+                continue
+            if mnemonic == ".END":
+                break
+            if mnemonic == ".ORIG":
+                raise ValueError("only one .ORIG block per file is supported")
+            program.append((number, address, mnemonic, tokens[1:]))
+            address += size_of(mnemonic, tokens[1:])
+            if address > 0x10000:
+                raise ValueError("program runs past the end of memory")
+        except ValueError as e:
+            raise AssemblyError(fname, number, str(e)) from None
+    if origin is None:
+        raise AssemblyError(fname, len(source.splitlines()), "no .ORIG found")
+
+    # Second pass: encode now that every label has an address
+    words = array("H")
+    for number, address, mnemonic, operands in program:
+        try:
+            words.extend(encode(mnemonic, operands, address, symbols))
+        except ValueError as e:
+            raise AssemblyError(fname, number, str(e)) from None
+    return origin, words, symbols
+
+
+def encode(mnemonic: str, operands: List[str], address: int, symbols: Dict[str, int]) -> List[int]:
+    """
+    Encodes one line at `address` into its words
+    """
+
+    def expect(count: int) -> None:
+        if len(operands) != count:
+            raise ValueError(f"{mnemonic} takes {count} operand(s), got {len(operands)}")
+
+    def register(token: str) -> int:
+        match = REGISTER.match(token)
+        if match is None:
+            raise ValueError(f"expected a register, got {token}")
+        return int(match.group(1))
+
+    def immediate(token: str, bits: int) -> int:
+        value = parse_number(token)
+        if value is None:
+            raise ValueError(f"expected a number, got {token}")
+        if not -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+            raise ValueError(f"{token} does not fit in {bits} signed bits")
+        return value & ((1 << bits) - 1)
+
+    def offset(token: str, bits: int) -> int:
+        if token in symbols:
+            value = symbols[token] - (address + 1)
+            if not -(1 << (bits - 1)) <= value < (1 << (bits - 1)):
+                raise ValueError(f"{token} is too far away for a {bits}-bit offset")
+            return value & ((1 << bits) - 1)
+        if parse_number(token) is None:
+            raise ValueError(f"undefined label {token}")
+        return immediate(token, bits)
+
+    if mnemonic == ".FILL":
+        expect(1)
+        value = symbols.get(operands[0])
+        if value is None:
+            value = parse_number(operands[0])
+        if value is None:
+            raise ValueError(f"undefined label {operands[0]}")
+        if not -0x8000 <= value <= 0xFFFF:
+            raise ValueError(f"{operands[0]} does not fit in 16 bits")
+        return [value & 0xFFFF]
+    if mnemonic == ".BLKW":
+        return [0] * parse_number(operands[0])
+    if mnemonic == ".STRINGZ":
+        return [ord(c) & 0xFFFF for c in parse_string(operands[0])] + [0]
+    if mnemonic in TRAPS:
+        expect(0)
+        return [0xF000 | TRAPS[mnemonic]]
+
+    branch = BRANCH.match(mnemonic)
+    if branch is not None:
+        expect(1)
+        flags = branch.group(1)
+        nzp = (("N" in flags) << 2 | ("Z" in flags) << 1 | ("P" in flags)) or 0b111
+        return [nzp << 9 | offset(operands[0], 9)]
+
+    op = OPCODES[mnemonic]
+    if mnemonic in ("ADD", "AND"):
+        expect(3)
+        dr, sr1 = register(operands[0]), register(operands[1])
+        if REGISTER.match(operands[2]):
+            return [op << 12 | dr << 9 | sr1 << 6 | register(operands[2])]
+        return [op << 12 | dr << 9 | sr1 << 6 | 1 << 5 | immediate(operands[2], 5)]
+    if mnemonic == "NOT":
+        expect(2)
+        return [op << 12 | register(operands[0]) << 9 | register(operands[1]) << 6 | 0x3F]
+    if mnemonic in ("LD", "LDI", "LEA", "ST", "STI"):
+        expect(2)
+        return [op << 12 | register(operands[0]) << 9 | offset(operands[1], 9)]
+    if mnemonic in ("LDR", "STR"):
+        expect(3)
+        return [
+            op << 12
+            | register(operands[0]) << 9
+            | register(operands[1]) << 6
+            | immediate(operands[2], 6)
+        ]
+    if mnemonic in ("JMP", "JSRR"):
+        expect(1)
+        return [op << 12 | register(operands[0]) << 6]
+    if mnemonic == "RET":
+        expect(0)
+        return [op << 12 | 7 << 6]
+    if mnemonic == "JSR":
+        expect(1)
+        return [op << 12 | 1 << 11 | offset(operands[0], 11)]
+    if mnemonic == "TRAP":
+        expect(1)
+        vector = parse_number(operands[0])
+        if vector is None or not 0 <= vector <= 0xFF:
+            raise ValueError(f"expected an 8-bit trap vector, got {operands[0]}")
+        return [op << 12 | vector]
+    # RTI
+    expect(0)
+    return [op << 12]
+
+
+def write_image(fname: str, origin: int, words: array) -> None:
+    """
+    Writes an .obj image: the origin followed by the words, all big-endian
+    """
+    data = array("H", words)
+    if sys.byteorder == "little":
+        data.byteswap()
+    with open(fname, "wb") as f:
+        f.write(origin.to_bytes(2, byteorder="big"))
+        f.write(data.tobytes())
+
+
+def write_symbols(fname: str, symbols: Dict[str, int]) -> None:
+    """
+    Writes a symbol table in the layout lc3as uses, which vm.read_symbols reads
+    """
+    with open(fname, "w") as f:
+        f.write("// Symbol table\n")
+        f.write("// Scope level 0:\n")
+        f.write("//\tSymbol Name       Page Address\n")
+        f.write("//\t----------------  ------------\n")
+        for name, address in sorted(symbols.items(), key=lambda item: item[1]):
+            f.write(f"//\t{name:<16}  {address:04X}\n")
+
+
+def build(source_path: str, cache_dir: Optional[str] = None) -> str:
+    """
+    Assembles `source_path` unless an identical source has been assembled
+    before, and returns the path of the cached .obj. Its symbol table is
+    next to it with a .sym suffix. The cache lives in `cache_dir`, by default
+    a __lc3cache__ directory beside the source.
+    """
+    with open(source_path, "rb") as f:
+        source = f.read()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIR)
+    digest = hashlib.sha256(b"lc3asm%d\0" % ASSEMBLER_VERSION + source).hexdigest()
+    obj_path = os.path.join(cache_dir, f"{digest}.obj")
+    if os.path.exists(obj_path):
+        return obj_path
+
+    origin, words, symbols = assemble(source.decode(), source_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write under temporary names so a concurrent build never sees half a file
+    suffix = f".{os.getpid()}.tmp"
+    write_symbols(obj_path[:-4] + ".sym" + suffix, symbols)
+    write_image(obj_path + suffix, origin, words)
+    os.replace(obj_path[:-4] + ".sym" + suffix, obj_path[:-4] + ".sym")
+    os.replace(obj_path + suffix, obj_path)
+    return obj_path
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Assemble LC-3 source into an .obj image")
+    parser.add_argument("source")
+    parser.add_argument(
+        "-o", "--output", help="image to write (default: the source name with .obj)"
+    )
+    parser.add_argument(
+        "--cache-dir", help=f"where assembled images are cached (default: {CACHE_DIR}/ beside the source)"
+    )
+    args = parser.parse_args(argv)
+
+    output = args.output or os.path.splitext(args.source)[0] + ".obj"
+    try:
+        obj_path = build(args.source, args.cache_dir)
+    except AssemblyError as e:
+        sys.exit(f"Error: {e}")
+    shutil.copyfile(obj_path, output)
+    shutil.copyfile(obj_path[:-4] + ".sym", os.path.splitext(output)[0] + ".sym")
+
+
+if __name__ == "__main__":
+    main()
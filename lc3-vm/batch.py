@@ -0,0 +1,131 @@
+"""
+Runs a directory of LC-3 images in parallel, one VM per task, and writes one
+JSON result per image:
+
+    python vm.py batch submissions/ --inputs scripts/ --output results.jsonl
+
+Each `name.obj` is fed the key presses in `name.in` from the inputs directory
+(the image directory by default), falling back to --input and then to no
+input at all.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+from vm import LC3VM, Keyboard, Output
+
+# Instructions run between wall-clock checks
+SLICE = 10_000
+
+
+def run_program(
+    image: str, input_path: Optional[str], max_instructions: int, timeout: float
+) -> Dict:
+    """
+    Runs one image to completion, budget or timeout and describes the outcome.
+    status is one of halted, budget, timeout, input_exhausted or error.
+    """
+    keyboard = Keyboard()
+    stdout = io.StringIO()
+    vm = LC3VM(keyboard, Output(stdout))
+    status = "budget"
+    error = None
+    start = time.monotonic()
+    try:
+        # A missing or unreadable input file fails this image, not the batch
+        if input_path:
+            with open(input_path, "rb") as f:
+                keyboard.feed(f.read())
+        keyboard.close()
+        vm.load_image(image)
+        while vm.instructions < max_instructions:
+            vm.run(min(SLICE, max_instructions - vm.instructions))
+            if vm.halted:
+                status = "halted"
+                break
+            if time.monotonic() - start > timeout:
+                status = "timeout"
+                break
+    except EOFError:
+        status = "input_exhausted"
+    except Exception as e:
+        status = "error"
+        error = f"{type(e).__name__}: {e}"
+    vm.output.flush()
+    return {
+        "image": image,
+        "input": input_path,
+        "status": status,
+        "halted": vm.halted,
+        "instructions": vm.instructions,
+        "seconds": round(time.monotonic() - start, 6),
+        "stdout": stdout.getvalue(),
+        "error": error,
+    }
+
+
+def find_jobs(
+    image_dir: str, input_dir: Optional[str], default_input: Optional[str]
+) -> List[Tuple[str, Optional[str]]]:
+    """
+    Pairs every .obj or .asm in `image_dir` with its scripted input file, if any
+    """
+    input_dir = input_dir or image_dir
+    jobs = []
+    for fname in sorted(os.listdir(image_dir)):
+        stem, ext = os.path.splitext(fname)
+        if ext not in (".obj", ".asm"):
+            continue
+        input_path = os.path.join(input_dir, stem + ".in")
+        if not os.path.exists(input_path):
+            input_path = default_input
+        jobs.append((os.path.join(image_dir, fname), input_path))
+    return jobs
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="lc3 batch")
+    parser.add_argument("image_dir", help="directory of .obj images or .asm sources")
+    parser.add_argument(
+        "--inputs", metavar="DIR", help="directory of NAME.in key press scripts"
+    )
+    parser.add_argument(
+        "--input", metavar="FILE", help="script for images without their own"
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max-instructions", type=int, default=10_000_000)
+    parser.add_argument(
+        "--timeout", type=float, default=10.0, help="wall-clock seconds per image"
+    )
+    parser.add_argument(
+        "--output", metavar="FILE", help="write JSONL here instead of stdout"
+    )
+    args = parser.parse_args(argv)
+
+    jobs = find_jobs(args.image_dir, args.inputs, args.input)
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            results = executor.map(
+                run_program,
+                [image for image, _ in jobs],
+                [input_path for _, input_path in jobs],
+                [args.max_instructions] * len(jobs),
+                [args.timeout] * len(jobs),
+            )
+            for result in results:
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
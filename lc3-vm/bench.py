@@ -0,0 +1,203 @@
+"""
+Measures interpreter throughput on the bundled images:
+
+    python vm.py bench --output before.json
+    python vm.py bench --compare before.json
+
+Each workload runs one image with canned key presses for a fixed
+instruction budget, in a process of its own so that peak RSS is per
+workload. The budget is timed in chunks of CHUNK instructions. A program
+that halts or runs out of keys is restored to its starting state and
+carries on, so every chunk does the same kind of work. Restores are timed
+separately and left out of MIPS and the percentiles.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from vm import LC3VM, Keyboard, Output, R
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Instructions per timed chunk; p50/p99 are reported per chunk
+CHUNK = 1_000_000
+
+# name: (image, canned key presses, first PC or None for the image's origin)
+WORKLOADS = {
+    "2048": ("2048.obj", b"y" + b"wasd" * 25_000, None),
+    "rogue": ("rogue.obj", b"x" + b"wwwwddddssssaaaa" * 10_000, None),
+    "sample": ("sample-out.obj", b"", None),
+    # main.asm puts its strings and constants first and its code at x3055.
+    # Run from x3000, the data decodes into a JSR #-1 at x304E that spins for
+    # the whole budget. From x3055 it runs 118 instructions and halts, so
+    # this workload mostly measures the cost of starting short runs (for the
+    # blocks engine, retranslating after every restore).
+    "main": ("main-out.obj", b"", 0x3055),
+}
+ENGINES = ("table", "blocks", "reference")
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    Nearest-rank percentile of `values`, `q` in [0, 1]
+    """
+    ordered = sorted(values)
+    rank = max(0, math.ceil(q * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def peak_rss_kib() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def bench_workload(name: str, engine: str, instructions: int, chunk: int = CHUNK) -> Dict:
+    """
+    Runs workload `name` on `engine` for `instructions` instructions and
+    returns its timings. Only full chunks count towards the percentiles.
+    """
+    image, keys, entry = WORKLOADS[name]
+    machine = LC3VM(Keyboard.from_bytes(keys), Output(open(os.devnull, "w")))
+    machine.load_image(os.path.join(HERE, image))
+    if entry is not None:
+        machine.reg[R.R_PC] = entry
+    start = machine.snapshot()
+    run = {
+        "table": machine.run,
+        "blocks": machine.run_blocks,
+        "reference": machine.run_reference,
+    }[engine]
+
+    chunk_seconds = []
+    restarts = 0
+    restart_seconds = 0.0
+    seconds = 0.0
+    remaining = instructions
+    while remaining > 0:
+        size = min(chunk, remaining)
+        done = 0
+        elapsed = 0.0
+        while done < size:
+            before = machine.instructions
+            run_start = time.perf_counter()
+            try:
+                run(size - done)
+            except EOFError:
+                machine.halted = True
+            elapsed += time.perf_counter() - run_start
+            done += machine.instructions - before
+            if machine.halted:
+                # Resetting the machine isn't interpreter work, so it's timed separately
+                restart_start = time.perf_counter()
+                machine.restore(start)
+                restart_seconds += time.perf_counter() - restart_start
+                restarts += 1
+        if size == chunk:
+            chunk_seconds.append(elapsed)
+        seconds += elapsed
+        remaining -= size
+
+    # Scale to milliseconds per million instructions whatever the chunk size
+    per_million = [s * 1e3 * 1_000_000 / chunk for s in chunk_seconds]
+    return {
+        "workload": name,
+        "image": image,
+        "engine": engine,
+        "instructions": instructions,
+        "seconds": round(seconds, 6),
+        "mips": round(instructions / seconds / 1e6, 4),
+        "p50_ms_per_m": round(percentile(per_million, 0.5), 3) if per_million else None,
+        "p99_ms_per_m": round(percentile(per_million, 0.99), 3) if per_million else None,
+        "restarts": restarts,
+        "restart_seconds": round(restart_seconds, 6),
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def compare(previous: Dict, current: Dict) -> None:
+    """
+    Prints the MIPS change of every workload present in both result sets
+    """
+    before = {(r["workload"], r["engine"]): r for r in previous["results"]}
+    print(f"\nvs {previous.get('commit') or 'previous run'}:")
+    for result in current["results"]:
+        old = before.get((result["workload"], result["engine"]))
+        if old is None:
+            continue
+        change = result["mips"] / old["mips"] - 1
+        print(
+            f"  {result['workload']:<8} {result['engine']:<10} "
+            f"{old['mips']:8.3f} -> {result['mips']:8.3f} MIPS ({change:+.1%})"
+        )
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="lc3 bench")
+    parser.add_argument(
+        "--workloads", nargs="+", choices=sorted(WORKLOADS), default=list(WORKLOADS)
+    )
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=["table", "blocks"])
+    parser.add_argument(
+        "--instructions", type=int, default=5_000_000, help="budget per workload and engine"
+    )
+    parser.add_argument("--output", metavar="FILE", help="write results as JSON")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="JSON from an earlier run to compare against"
+    )
+    args = parser.parse_args(argv)
+
+    jobs = [(name, engine) for name in args.workloads for engine in args.engines]
+    results = []
+    # One fresh process per job, run one at a time so they don't compete for CPU
+    with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+        futures = [
+            pool.submit(bench_workload, name, engine, args.instructions) for name, engine in jobs
+        ]
+        for future in futures:
+            result = future.result()
+            results.append(result)
+            p50, p99 = result["p50_ms_per_m"], result["p99_ms_per_m"]
+            print(
+                f"{result['workload']:<8} {result['engine']:<10} {result['mips']:8.3f} MIPS"
+                f"  p50 {p50 or '-':>8} ms/M  p99 {p99 or '-':>8} ms/M"
+                f"  peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB"
+            )
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "chunk": CHUNK,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
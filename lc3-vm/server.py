@@ -0,0 +1,246 @@
+"""
+Serves an LC-3 program over TCP, one VM per connection, all on one asyncio
+event loop:
+
+    python vm.py serve 2048.obj --port 4000
+    nc localhost 4000
+
+Each session runs in slices of SLICE instructions and yields to the loop
+between them. A session that waits in GETC/IN, or polls KBSR with no key,
+is paused until the client sends something. A program that polls KBSR
+while it keeps working (a game loop, say) is told "no key" at most once per
+--poll-interval. Each time it comes back to the same poll without having
+written memory or output since the last one, it is most likely just waiting
+for a key, so the interval doubles, up to --max-poll-interval. Idle sessions
+then cost next to nothing, while a program that counts down in a register
+between polls still gets to time out.
+"""
+
+from typing import List, Optional, Set
+import argparse
+import asyncio
+import sys
+
+from vm import LC3VM, InputWait, Keyboard, Output, R, Snapshot
+
+# Instructions run before yielding to other sessions
+SLICE = 10_000
+# Seconds a polling program waits for a key before it sees an empty KBSR
+POLL_INTERVAL = 0.05
+# Longest such wait, reached by a program that keeps polling in the same state
+MAX_POLL_INTERVAL = 2.0
+
+
+class SessionKeyboard(Keyboard):
+    """
+    Keys sent by one client. Never blocks: raises InputWait instead, and
+    sets `arrived` whenever keys arrive or the client goes away.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.arrived = asyncio.Event()
+        # Lets the next empty KBSR poll through, once the poll interval has passed
+        self.allow_empty_poll = False
+
+    def feed(self, data: bytes) -> None:
+        super().feed(data)
+        self.arrived.set()
+
+    def close(self) -> None:
+        super().close()
+        self.arrived.set()
+
+    def read(self) -> int:
+        if not self.keys and not self.closed:
+            raise InputWait(polling=False)
+        return super().read()
+
+    def empty_poll(self) -> None:
+        if self.closed:
+            # Nothing more can arrive, so don't let the program spin forever
+            raise EOFError("Keyboard input exhausted")
+        if self.allow_empty_poll:
+            self.allow_empty_poll = False
+            return
+        raise InputWait(polling=True)
+
+    async def wait(self, timeout: Optional[float]) -> bool:
+        """
+        Waits up to `timeout` seconds (forever if None) for keys or for the
+        client to disconnect. Returns False on timeout.
+        """
+        if self.keys or self.closed:
+            return True
+        self.arrived.clear()
+        try:
+            await asyncio.wait_for(self.arrived.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class SocketStream:
+    """
+    Text stream over a StreamWriter for Output to flush into
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+    def write(self, text: str) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(text.encode("latin-1", errors="replace"))
+
+    def flush(self) -> None:
+        pass
+
+
+async def pump_keys(reader: asyncio.StreamReader, keyboard: SessionKeyboard) -> None:
+    try:
+        while True:
+            data = await reader.read(256)
+            if not data:
+                break
+            keyboard.feed(data)
+    finally:
+        keyboard.close()
+
+
+async def run_session(
+    vm: LC3VM,
+    keyboard: SessionKeyboard,
+    writer: asyncio.StreamWriter,
+    slice_size: int = SLICE,
+    poll_interval: float = POLL_INTERVAL,
+    max_poll_interval: float = MAX_POLL_INTERVAL,
+) -> None:
+    """
+    Runs `vm` until it halts or its client disconnects and input runs out
+    """
+    # PC, characters written and RAM at the last empty KBSR poll
+    last_poll = None
+    interval = poll_interval
+    while not vm.halted:
+        try:
+            vm.run(slice_size)
+        except InputWait as wait:
+            vm.output.flush()
+            await writer.drain()
+            timeout = None
+            if wait.polling:
+                poll = (vm.reg[R.R_PC], vm.output.written, vm.ram[:])
+                # Polling again in the same state probably means the program
+                # has nothing else to do, but it may be counting in a
+                # register, so wake it less often rather than never
+                if poll == last_poll:
+                    interval = min(interval * 2, max_poll_interval)
+                else:
+                    interval = poll_interval
+                last_poll = poll
+                timeout = interval
+            got_input = await keyboard.wait(timeout)
+            if not got_input:
+                keyboard.allow_empty_poll = True
+            continue
+        except EOFError:
+            break
+        # Sessions that never wait for input still take turns
+        if vm.output.parts:
+            vm.output.flush()
+        await writer.drain()
+        await asyncio.sleep(0)
+    vm.output.flush()
+
+
+class Host:
+    """
+    Accepts connections and starts each one from the same loaded program
+    """
+
+    def __init__(
+        self,
+        images: List[str],
+        slice_size: int = SLICE,
+        poll_interval: float = POLL_INTERVAL,
+        flush_threshold: int = 4096,
+        max_poll_interval: float = MAX_POLL_INTERVAL,
+    ):
+        template = LC3VM()
+        template.load_images(images)
+        # Sessions start by copying this rather than re-reading the images
+        self.start: Snapshot = template.snapshot()
+        self.slice_size = slice_size
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.flush_threshold = flush_threshold
+        # VMs of the connected clients
+        self.sessions: Set[LC3VM] = set()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        keyboard = SessionKeyboard()
+        vm = LC3VM(keyboard, Output(SocketStream(writer), self.flush_threshold))
+        vm.restore(self.start)
+        pump = asyncio.create_task(pump_keys(reader, keyboard))
+        self.sessions.add(vm)
+        try:
+            await run_session(
+                vm,
+                keyboard,
+                writer,
+                self.slice_size,
+                self.poll_interval,
+                self.max_poll_interval,
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(vm)
+            pump.cancel()
+            writer.close()
+
+
+async def serve(host: Host, address: str, port: int) -> None:
+    server = await asyncio.start_server(host.handle, address, port)
+    names = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+    print(f"Serving on {names}", file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="lc3 serve")
+    parser.add_argument("images", nargs="+", metavar="image-file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument(
+        "--slice", type=int, default=SLICE, help="instructions per turn on the event loop"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=POLL_INTERVAL,
+        metavar="SECONDS",
+        help="how long a program polling KBSR waits for a key before seeing none",
+    )
+    parser.add_argument(
+        "--max-poll-interval",
+        type=float,
+        default=MAX_POLL_INTERVAL,
+        metavar="SECONDS",
+        help="the longest that wait grows to while the program polls in the same state",
+    )
+    args = parser.parse_args(argv)
+
+    host = Host(
+        args.images, args.slice, args.poll_interval, max_poll_interval=args.max_poll_interval
+    )
+    try:
+        asyncio.run(serve(host, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import io
+import os
+import shutil
+
+import pytest
+
+import assembler
+from assembler import AssemblyError, assemble, build
+from vm import LC3VM, Keyboard, Output, read_image, read_symbols
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.mark.parametrize(
+    "source, image",
+    [("print_ascii.asm", "sample-out.obj"), ("keyboard_echo.asm", "check_kb-out.obj")],
+)
+def test_assemble_matches_checked_in_images(source, image):
+    with open(os.path.join(HERE, source)) as f:
+        origin, words, symbols = assemble(f.read(), source)
+    assert (origin, words) == read_image(os.path.join(HERE, image))
+    assert origin <= symbols["ASCII_ZERO"] < origin + len(words)
+
+
+def test_assemble_reports_line_of_error():
+    with pytest.raises(AssemblyError, match=r"bad.asm:3: undefined label NOWHERE"):
+        assemble(".ORIG x3000\nAND R0, R0, #0\nBRz NOWHERE\n.END\n", "bad.asm")
+    with pytest.raises(AssemblyError, match=r"bad.asm:2: .*5 signed bits"):
+        assemble(".ORIG x3000\nADD R0, R0, #16\n", "bad.asm")
+
+
+def test_build_only_assembles_changed_sources(tmp_path, monkeypatch):
+    source = tmp_path / "print_ascii.asm"
+    shutil.copyfile(os.path.join(HERE, "print_ascii.asm"), source)
+    obj_path = build(str(source))
+    assert read_symbols(obj_path[:-4] + ".sym")[0x300B] == "ASCII_ZERO"
+
+    def fail(*args):
+        raise AssertionError("unchanged source was assembled again")
+
+    monkeypatch.setattr(assembler, "assemble", fail)
+    assert build(str(source)) == obj_path
+
+    source.write_text(source.read_text().replace("x002A", "x0002"))
+    with pytest.raises(AssertionError):
+        build(str(source))
+
+
+def test_vm_runs_assembly_source(tmp_path):
+    source = tmp_path / "print_ascii.asm"
+    shutil.copyfile(os.path.join(HERE, "print_ascii.asm"), source)
+    machine = LC3VM(Keyboard.from_bytes(b""), Output(io.StringIO()))
+    machine.load_image(str(source))
+    machine.run()
+    assert machine.output.stream.getvalue().endswith("Z\nHALT!\n")
@@ -0,0 +1,33 @@
+import os
+
+from batch import find_jobs, run_program
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_run_program_reports_halt_and_budget():
+    result = run_program(os.path.join(HERE, "sample-out.obj"), None, 10_000, 5.0)
+    assert result["status"] == "halted"
+    assert result["stdout"].endswith("Z\nHALT!\n")
+
+    result = run_program(os.path.join(HERE, "check_kb-out.obj"), None, 1_000, 5.0)
+    assert result["status"] == "budget"
+    assert result["instructions"] == 1_000
+
+
+def test_run_program_reports_unreadable_input_as_error(tmp_path):
+    missing = str(tmp_path / "missing.in")
+    result = run_program(os.path.join(HERE, "sample-out.obj"), missing, 1_000, 5.0)
+    assert result["status"] == "error"
+    assert result["error"].startswith("FileNotFoundError")
+    assert result["instructions"] == 0
+
+
+def test_find_jobs_pairs_images_with_inputs(tmp_path):
+    for name in ("a.obj", "b.obj", "a.in", "notes.txt"):
+        (tmp_path / name).write_bytes(b"")
+    jobs = find_jobs(str(tmp_path), None, "default.in")
+    assert jobs == [
+        (str(tmp_path / "a.obj"), str(tmp_path / "a.in")),
+        (str(tmp_path / "b.obj"), "default.in"),
+    ]
@@ -0,0 +1,40 @@
+import json
+
+import bench
+from bench import bench_workload, percentile
+
+
+def test_percentile_uses_nearest_rank():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 0.5) == 50.0
+    assert percentile(values, 0.99) == 99.0
+    assert percentile([3.0], 0.99) == 3.0
+
+
+def test_bench_workload_restarts_halting_programs():
+    result = bench_workload("sample", "table", 25_000, chunk=10_000)
+    assert result["instructions"] == 25_000
+    assert result["restarts"] > 0
+    assert result["mips"] > 0
+    assert result["p50_ms_per_m"] <= result["p99_ms_per_m"]
+    assert result["peak_rss_kib"] > 0
+
+
+def test_bench_workload_starts_main_at_its_code():
+    result = bench_workload("main", "table", 1_000)
+    # Each run is 118 instructions, rather than one spin loop that never halts
+    assert result["restarts"] == 1_000 // 118
+
+
+def test_main_writes_json_report(tmp_path, capsys):
+    output = tmp_path / "bench.json"
+    bench.main(
+        ["--workloads", "2048", "--engines", "table", "--instructions", "20000", "--output", str(output)]
+    )
+    report = json.loads(output.read_text())
+    assert [(r["workload"], r["engine"]) for r in report["results"]] == [("2048", "table")]
+
+    bench.main(
+        ["--workloads", "2048", "--engines", "table", "--instructions", "20000", "--compare", str(output)]
+    )
+    assert "2048     table" in capsys.readouterr().out
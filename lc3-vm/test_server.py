@@ -0,0 +1,130 @@
+import asyncio
+import io
+import os
+
+import pytest
+
+from server import Host, SessionKeyboard
+from vm import LC3VM, InputWait, Output
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_run_rewinds_instruction_waiting_for_input():
+    keyboard = SessionKeyboard()
+    machine = LC3VM(keyboard, Output(io.StringIO()))
+    machine.load_image(os.path.join(HERE, "check_kb-out.obj"))
+    with pytest.raises(InputWait) as wait:
+        machine.run(1_000)
+    assert wait.value.polling
+    pc, instructions = machine.reg.r[8], machine.instructions
+    with pytest.raises(InputWait):
+        machine.run(1_000)
+    assert (machine.reg.r[8], machine.instructions) == (pc, instructions)
+
+    keyboard.feed(b"a")
+    with pytest.raises(InputWait):
+        machine.run(1_000)
+    assert machine.output.stream.getvalue() == "a"
+
+
+async def talk(port, send, expect):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(send)
+    data = b""
+    while not data.endswith(expect):
+        chunk = await asyncio.wait_for(reader.read(256), 5)
+        assert chunk, data
+        data += chunk
+    writer.close()
+    return data
+
+
+def test_host_serves_concurrent_sessions():
+    async def scenario():
+        echo = Host([os.path.join(HERE, "check_kb-out.obj")], poll_interval=0.01)
+        sample = Host([os.path.join(HERE, "sample-out.obj")])
+        echo_server = await asyncio.start_server(echo.handle, "127.0.0.1", 0)
+        sample_server = await asyncio.start_server(sample.handle, "127.0.0.1", 0)
+        echo_port = echo_server.sockets[0].getsockname()[1]
+        sample_port = sample_server.sockets[0].getsockname()[1]
+        async with echo_server, sample_server:
+            # Idle clients stay connected without keeping the loop busy
+            idle = [await asyncio.open_connection("127.0.0.1", echo_port) for _ in range(20)]
+            await asyncio.sleep(0.2)
+            assert len(echo.sessions) == 20
+            assert all(vm.instructions < 10_000 for vm in echo.sessions)
+
+            results = await asyncio.gather(
+                talk(echo_port, b"hello", b"hello"),
+                talk(echo_port, b"world", b"world"),
+                talk(sample_port, b"", b"HALT!\n"),
+            )
+            for _, writer in idle:
+                writer.close()
+        return results
+
+    hello, world, sample = asyncio.run(scenario())
+    assert (hello, world) == (b"hello", b"world")
+    assert sample.endswith(b"Z\nHALT!\n")
+
+
+def test_idle_polling_sessions_back_off():
+    async def scenario():
+        # 2048 polls KBSR at its title screen, changing nothing but a register
+        host = Host([os.path.join(HERE, "2048.obj")], poll_interval=0.01, max_poll_interval=0.08)
+        server = await asyncio.start_server(host.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            idle = [await asyncio.open_connection("127.0.0.1", port) for _ in range(5)]
+            # Long enough for the interval to reach its cap
+            await asyncio.sleep(0.3)
+            before = [vm.instructions for vm in host.sessions]
+            await asyncio.sleep(0.4)
+            after = [vm.instructions for vm in host.sessions]
+            # but a key wakes them straight away
+            idle[0][1].write(b"y")
+            await asyncio.sleep(0.1)
+            woken = sum(vm.instructions for vm in host.sessions)
+            for _, writer in idle:
+                writer.close()
+            await asyncio.sleep(0.05)
+        return before, after, woken
+
+    before, after, woken = asyncio.run(scenario())
+    assert len(before) == 5
+    # At most one 3-instruction poll loop per 0.08s, rather than per 0.01s
+    assert all(0 < b - a <= 3 * 6 for a, b in zip(before, after))
+    assert woken > sum(after) + 100
+
+
+COUNTDOWN = """
+.ORIG x3000
+        LD R1, COUNT
+POLL    LDI R2, KBSR_PTR
+        BRn GOT
+        ADD R1, R1, #-1
+        BRp POLL
+        LEA R0, MSG
+        PUTS
+GOT     HALT
+COUNT   .FILL #8
+KBSR_PTR .FILL xFE00
+MSG     .STRINGZ "timeout"
+.END
+"""
+
+
+def test_polling_program_counting_in_a_register_still_times_out(tmp_path):
+    # Between polls only R1 changes, so every poll after the first looks the same
+    source = tmp_path / "countdown.asm"
+    source.write_text(COUNTDOWN)
+
+    async def scenario():
+        host = Host([str(source)], poll_interval=0.001, max_poll_interval=0.01)
+        server = await asyncio.start_server(host.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await talk(port, b"", b"HALT!\n")
+
+    assert asyncio.run(scenario()) == b"timeoutHALT!\n"
@@ -0,0 +1,260 @@
+import io
+import os
+
+import pytest
+
+import vm
+from vm import LC3VM, Keyboard, Memory, Output, Registers, TraceHash, OP, R, decode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def make_vm(image, keys=b""):
+    machine = LC3VM(Keyboard.from_bytes(keys), Output(io.StringIO()))
+    machine.load_image(os.path.join(HERE, image))
+    return machine
+
+
+def test_decode_sign_extends_immediates():
+    # ADD R1, R2, #-1
+    assert decode(0x12BF) == (OP.OP_ADD, 1, 2, 1, 0xFFFF)
+    # BRnzp #-2
+    assert decode(0x0FFE) == (OP.OP_BR, 7, 7, 0, 0xFFFE)
+    # TRAP x25
+    assert decode(0xF025) == (OP.OP_TRAP, 0, 0, 0, 0x25)
+
+
+def test_fetch_is_invalidated_on_write():
+    mem = Memory()
+    mem[0x3000] = 0x12BF
+    assert mem.fetch(0x3000)[0] == OP.OP_ADD
+    mem[0x3000] = 0xF025
+    assert mem.fetch(0x3000) == (OP.OP_TRAP, 0, 0, 0, 0x25)
+
+
+def test_table_engine_matches_reference():
+    expected = make_vm("sample-out.obj")
+    expected.run_reference()
+    actual = make_vm("sample-out.obj")
+    actual.run()
+    assert actual.output.stream.getvalue() == expected.output.stream.getvalue()
+    assert actual.output.stream.getvalue().endswith("Z\nHALT!\n")
+    assert actual.reg.r == expected.reg.r
+    assert actual.mem.ram == expected.mem.ram
+
+
+def test_memory_masks_addresses_and_values():
+    mem = Memory()
+    mem[0x13000] = 0x1ABCD
+    assert mem[0x3000] == 0xABCD
+    regs = Registers()
+    regs[R.R_R1] = -1
+    assert regs[R.R_R1] == 0xFFFF
+
+
+def test_load_images_reports_overlaps(capsys, tmp_path):
+    first = tmp_path / "first.obj"
+    first.write_bytes(bytes([0x30, 0x00, 0x12, 0xBF, 0xF0, 0x25]))
+    second = tmp_path / "second.obj"
+    second.write_bytes(bytes([0x30, 0x01, 0xAB, 0xCD]))
+    machine = LC3VM()
+
+    loaded = machine.load_images([str(first), str(second)])
+
+    assert loaded == [(str(first), 0x3000, 2), (str(second), 0x3001, 1)]
+    assert list(machine.mem.ram[0x3000:0x3002]) == [0x12BF, 0xABCD]
+    assert "overlaps" in capsys.readouterr().err
+
+
+def test_scripted_keyboard_feeds_kbsr_and_kbdr(tmp_path):
+    script = tmp_path / "keys.txt"
+    script.write_bytes(b"ab")
+    keyboard = Keyboard.from_file(str(script))
+    mem = Memory(keyboard=keyboard)
+
+    assert mem[vm.KBSR] == 1 << 15
+    assert mem[vm.KBDR] == ord("a")
+    assert keyboard.read() == ord("b")
+    assert mem[vm.KBSR] == 0
+    with pytest.raises(EOFError):
+        keyboard.read()
+
+
+def test_output_flushes_at_threshold():
+    stream = io.StringIO()
+    out = Output(stream, flush_threshold=4)
+    out.write("abc")
+    assert stream.getvalue() == ""
+    out.write("d")
+    assert stream.getvalue() == "abcd"
+    out.write("e")
+    out.flush()
+    assert stream.getvalue() == "abcde"
+
+
+def test_run_stops_at_instruction_budget():
+    machine = make_vm("2048.obj", keys=b"y")
+    assert machine.run(max_instructions=1000) == 1000
+    assert machine.instructions == 1000
+    assert not machine.halted
+    machine.step()
+    assert machine.instructions == 1001
+
+
+def test_restore_rewinds_to_snapshot():
+    machine = make_vm("sample-out.obj")
+    snapshot = machine.snapshot()
+    machine.run()
+    assert machine.halted
+    machine.restore(snapshot)
+    assert not machine.halted
+    assert machine.reg[R.R_PC] == vm.PC_START
+    machine.output.stream.truncate(0)
+    machine.output.stream.seek(0)
+    machine.run()
+    assert machine.output.stream.getvalue().endswith("Z\nHALT!\n")
+
+
+def test_lazy_flags_match_eager_flags():
+    keys = b"y" + b"wasd" * 50
+    expected = LC3VM(Keyboard.from_bytes(keys), Output(io.StringIO()), eager_flags=True)
+    expected.load_image(os.path.join(HERE, "2048.obj"))
+    actual = make_vm("2048.obj", keys)
+    for _ in range(2_000):
+        expected.run(max_instructions=37)
+        actual.run(max_instructions=37)
+        assert actual.last_result is None
+        assert actual.reg.r == expected.reg.r
+    assert actual.mem.ram == expected.mem.ram
+    assert actual.output.stream.getvalue() == expected.output.stream.getvalue()
+
+
+def test_snapshot_file_round_trip(tmp_path):
+    keys = b"y" + b"wasd" * 50
+    expected = make_vm("2048.obj", keys)
+    expected.run(max_instructions=50_000)
+    path = str(tmp_path / "2048.snap")
+    expected.save_snapshot(path)
+    expected.run(max_instructions=50_000)
+
+    actual = make_vm("2048.obj")
+    actual.load_snapshot(path)
+    assert actual.instructions == 50_000
+    actual.run(max_instructions=50_000)
+    assert actual.reg.r == expected.reg.r
+    assert actual.mem.ram == expected.mem.ram
+    assert bytes(actual.keyboard.keys) == bytes(expected.keyboard.keys)
+
+
+def test_load_snapshot_rejects_other_files(tmp_path):
+    path = tmp_path / "bogus.snap"
+    path.write_bytes(b"not a snapshot at all")
+    with pytest.raises(ValueError):
+        make_vm("2048.obj").load_snapshot(str(path))
+
+
+def test_trace_hash_matches_reference_engine():
+    keys = b"y" + b"wasd" * 50
+    expected = make_vm("2048.obj", keys)
+    expected_trace = TraceHash(interval=10_000)
+    assert expected.run_reference(max_instructions=100_000, trace=expected_trace) == 100_000
+    actual = make_vm("2048.obj", keys)
+    actual_trace = TraceHash(interval=10_000)
+    assert actual.run_traced(actual_trace, max_instructions=100_000) == 100_000
+    assert len(actual_trace.finish()) == 10
+    assert actual_trace.finish() == expected_trace.finish()
+    assert actual.instructions == expected.instructions
+
+
+def test_first_divergence_finds_first_mismatched_checkpoint():
+    trace = [(10, "a"), (20, "b"), (30, "c")]
+    assert vm.first_divergence(trace, list(trace)) is None
+    assert vm.first_divergence(trace, [(10, "a"), (20, "x"), (30, "y")]) == 20
+    assert vm.first_divergence(trace, trace[:2]) == 20
+
+
+def test_block_engine_matches_table_engine():
+    keys = b"y" + b"wasd" * 50
+    expected = make_vm("2048.obj", keys)
+    expected.run(max_instructions=200_000)
+    actual = make_vm("2048.obj", keys)
+    assert actual.run_blocks(max_instructions=200_000) == 200_000
+    assert actual.output.stream.getvalue() == expected.output.stream.getvalue()
+    assert actual.reg.r == expected.reg.r
+    assert actual.mem.ram == expected.mem.ram
+
+
+def test_blocks_see_self_modifying_stores(tmp_path):
+    image = tmp_path / "smc.obj"
+    words = [
+        0x3000,
+        0x2204,  # LD R1, x3005
+        0x3201,  # ST R1, x3003
+        0x1021,  # ADD R0, R0, #1
+        0x1021,  # ADD R0, R0, #1, overwritten with ADD R0, R0, #5
+        0xF025,  # HALT
+        0x1025,
+    ]
+    image.write_bytes(b"".join(w.to_bytes(2, "big") for w in words))
+    machine = LC3VM(output=Output(io.StringIO()))
+    machine.load_image(str(image))
+    machine.run_blocks()
+    assert machine.halted
+    assert machine.reg[R.R_R0] == 6
+
+
+def test_profiler_counts_match_run(tmp_path):
+    machine = make_vm("sample-out.obj")
+    profiler = vm.Profiler()
+    executed = machine.run_profiled(profiler)
+    assert machine.halted
+    assert profiler.instructions == executed == sum(profiler.ops) == sum(profiler.pcs)
+    assert profiler.traps[vm.T.TRAP_HALT] == 1
+
+    symbols = tmp_path / "sample.sym"
+    symbols.write_text("//\tSymbol Name       Page Address\n//\tSTART             3000\n")
+    labels = vm.read_symbols(str(symbols))
+    assert vm.symbol_name(labels, 0x3002) == "START+2"
+    assert vm.symbol_name(labels, 0x2FFF, addresses=sorted(labels)) == "x2FFF"
+    folded = tmp_path / "sample.folded"
+    profiler.write_folded(str(folded), labels)
+    assert folded.read_text() == f"START {executed}\n"
+
+
+def test_running_out_of_input_leaves_pc_on_the_read():
+    states = []
+    for engine in ("run", "run_blocks", "run_reference", "run_profiled"):
+        machine = make_vm("rogue.obj")
+        args = (vm.Profiler(),) if engine == "run_profiled" else ()
+        with pytest.raises(EOFError):
+            getattr(machine, engine)(*args)
+        snapshot = machine.snapshot()
+        states.append((machine.instructions, snapshot.ram, snapshot.registers))
+    assert all(state == states[0] for state in states)
+    assert states[0][0] == 2
+
+    # Resuming from the checkpoint runs the GETC that found no key
+    resumed = make_vm("rogue.obj", b"x")
+    resumed.restore(snapshot._replace(keys=b"x"))
+    resumed.run(10_000 - resumed.instructions)
+    straight = make_vm("rogue.obj", b"x")
+    straight.run(10_000)
+    assert resumed.snapshot() == straight.snapshot()
+
+
+def test_profiler_takes_back_a_read_that_runs_out_of_input(tmp_path):
+    # GETC first thing, with no keys to read
+    image = tmp_path / "getc.obj"
+    image.write_bytes(bytes([0x30, 0x00, 0xF0, 0x20, 0xF0, 0x25]))
+    machine = LC3VM(Keyboard.from_bytes(b""), Output(io.StringIO()))
+    machine.load_image(str(image))
+    profiler = vm.Profiler()
+    with pytest.raises(EOFError):
+        machine.run_profiled(profiler)
+    assert machine.instructions == profiler.instructions == 0
+    assert len(profiler.ops) == 16 and not any(profiler.ops)
+    assert len(profiler.pcs) == vm.MEM_SIZE and not any(profiler.pcs)
+    assert not profiler.traps and not profiler.stacks
+    report = io.StringIO()
+    profiler.report(file=report)
+    assert "instructions: 0" in report.getvalue()
@@ -1,10 +1,20 @@
-from typing import List
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, TextIO, Tuple
 from enum import IntEnum, auto
+from array import array
+from bisect import bisect_right
+from collections import Counter, deque
+import argparse
 import termios
-import select
+import threading
 import signal
 import atexit
 import sys
+import os
+import time
+import struct
+import hashlib
+
+import assembler
 
 
 class Register(IntEnum):
@@ -60,43 +70,242 @@ class MemoryMappedRegisters(IntEnum):
     MR_KBDR = 0xFE02
 
 
+# Plain int copies of the enum members touched on every instruction. Indexing or
+# comparing with an IntEnum member costs an attribute lookup plus __index__/__eq__.
+REG_R0: int = Register.R_R0.value
+REG_R7: int = Register.R_R7.value
+REG_PC: int = Register.R_PC.value
+REG_COND: int = Register.R_COND.value
+OP_JSR: int = Opcodes.OP_JSR.value
+OP_JMP: int = Opcodes.OP_JMP.value
+OP_TRAP: int = Opcodes.OP_TRAP.value
+KBSR: int = MemoryMappedRegisters.MR_KBSR.value
+KBDR: int = MemoryMappedRegisters.MR_KBDR.value
+# Loads below this address can never hit a memory mapped register
+MMIO_START: int = 0xFE00
+
+# (op, dr/sr/nzp, sr1/base_r, flag, imm) with the immediate already sign-extended.
+# See decode() for what each slot holds per opcode.
+Decoded = Tuple[int, int, int, int, int]
+
+
 class Memory:
-    def __init__(self, mem_size: int = 2**16):
+    def __init__(
+        self,
+        mem_size: int = 2**16,
+        keyboard: Optional["Keyboard"] = None,
+        output: Optional["Output"] = None,
+    ):
         self.mem_size = mem_size
-        self.ram = [0 for _ in range(mem_size)]
+        self.keyboard = keyboard if keyboard is not None else Keyboard()
+        self.output = output if output is not None else Output()
+        self.ram = array("H", bytes(2 * mem_size))
+        # Decoded instructions keyed by address, dropped whenever that address is written
+        self.decoded: List[Optional[Decoded]] = [None for _ in range(mem_size)]
+        # Translated basic blocks keyed by start address (None: interpret this address).
+        # `code` marks every address covered by a block so stores can tell when
+        # they overwrite translated code.
+        self.blocks: Dict[int, Optional[Callable]] = {}
+        self.code = bytearray(mem_size)
 
     def __getitem__(self, address) -> int:
         # TODO: Kludge to cooerce addresses to be uint16
         address = address & 0xFFFF
-        if address == MR.MR_KBSR:
-            if check_key():
-                self.ram[MR.MR_KBSR] = 1 << 15
-                self.ram[MR.MR_KBDR] = ord(get_char())
-            else:
-                # print("Setting to 0")
-                self.ram[MR.MR_KBSR] = 0
+        if address == KBSR:
+            self.poll_keyboard()
         return self.ram[address]
 
+    def poll_keyboard(self) -> None:
+        # Keys are buffered by the keyboard, so polling is a deque check, not a syscall
+        keys = self.keyboard.keys
+        if keys:
+            self.ram[KBSR] = 1 << 15
+            self.ram[KBDR] = keys.popleft()
+            self.decoded[KBDR] = None
+        else:
+            # Busy-wait input loops never reach GETC, so flush here for them
+            if self.output.parts:
+                self.output.flush()
+            self.keyboard.empty_poll()
+            self.ram[KBSR] = 0
+        self.decoded[KBSR] = None
+
+    def fetch(self, address: int) -> Decoded:
+        """
+        Returns the decoded instruction at `address`, decoding it on first use
+        """
+        address = address & 0xFFFF
+        decoded = self.decoded[address]
+        if decoded is None:
+            decoded = self.decoded[address] = decode(self[address])
+        return decoded
+
+    def load(self, origin: int, words: array) -> None:
+        """
+        Copies a block of words straight into RAM starting at `origin`
+        """
+        end = origin + len(words)
+        self.ram[origin:end] = words
+        self.invalidate(origin, end)
+
+    def invalidate(self, start: int, end: int) -> None:
+        """
+        Forgets decoded instructions and translated blocks for RAM that was
+        replaced without going through __setitem__
+        """
+        self.decoded[start:end] = [None] * (end - start)
+        if self.blocks:
+            self.invalidate_blocks()
+
+    def invalidate_blocks(self) -> None:
+        """
+        Drops every translated block. Self-modifying code is rare enough that
+        tracking which blocks cover an address isn't worth it.
+        """
+        self.blocks.clear()
+        # Cleared in place: translated blocks hold a reference to this bytearray
+        self.code[:] = bytes(len(self.code))
+
     def __setitem__(self, address: int, val: int) -> None:
         # TODO: Kludge to cooerce addresses to be uint16
         address = address & 0xFFFF
-        assert 0 <= address < self.mem_size
         self.ram[address] = val & 0xFFFF
+        self.decoded[address] = None
+        if self.code[address]:
+            self.invalidate_blocks()
 
 
 class Registers:
     def __init__(self, size: int = Register.R_COUNT):
         self.size = size
-        self.r = [0 for _ in range(R.R_COUNT)]
+        self.r = array("H", bytes(2 * size))
 
     def __getitem__(self, reg_idx: int) -> int:
         return self.r[reg_idx]
 
     def __setitem__(self, reg_idx: int, val: int) -> int:
-        assert 0 <= reg_idx < self.size
         self.r[reg_idx] = val & 0xFFFF
 
 
+class InputWait(Exception):
+    """
+    Raised by a non-blocking keyboard when the program needs a key that hasn't
+    arrived yet. LC3VM.run() rewinds the instruction that asked, so the run
+    can simply be resumed once there is input. `polling` is True when the
+    program was polling KBSR rather than waiting in GETC/IN.
+    """
+
+    def __init__(self, polling: bool):
+        super().__init__("waiting for input")
+        self.polling = polling
+
+
+class Keyboard:
+    """
+    Pending key presses, oldest first. Keys are either pushed in by a
+    background thread reading a file descriptor (see `from_fd`) or loaded up
+    front from a script (see `from_file`). Once closed, reading past the last
+    key raises EOFError.
+    """
+
+    def __init__(self):
+        self.keys: Deque[int] = deque()
+        self.closed = False
+        self.ready = threading.Condition()
+        # Seconds spent blocked in read() waiting for a key
+        self.wait_time = 0.0
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Keyboard":
+        keyboard = cls()
+        keyboard.feed(data)
+        keyboard.close()
+        return keyboard
+
+    @classmethod
+    def from_file(cls, fname: str) -> "Keyboard":
+        with open(fname, "rb") as f:
+            return cls.from_bytes(f.read())
+
+    @classmethod
+    def from_fd(cls, fd: int) -> "Keyboard":
+        keyboard = cls()
+        threading.Thread(target=keyboard.pump, args=(fd,), daemon=True).start()
+        return keyboard
+
+    def pump(self, fd: int) -> None:
+        """
+        Copies bytes from `fd` into the buffer until end of file
+        """
+        while True:
+            data = os.read(fd, 64)
+            if not data:
+                break
+            self.feed(data)
+        self.close()
+
+    def feed(self, data: bytes) -> None:
+        with self.ready:
+            self.keys.extend(data)
+            self.ready.notify_all()
+
+    def close(self) -> None:
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+
+    def empty_poll(self) -> None:
+        """
+        Called when the program polls KBSR and there is no key. Subclasses can
+        raise InputWait here to pause the VM instead of letting it spin.
+        """
+
+    def read(self) -> int:
+        """
+        Returns the next key, waiting for one if the buffer is empty
+        """
+        with self.ready:
+            while not self.keys:
+                if self.closed:
+                    raise EOFError("Keyboard input exhausted")
+                start = time.perf_counter()
+                self.ready.wait()
+                self.wait_time += time.perf_counter() - start
+            return self.keys.popleft()
+
+
+class Output:
+    """
+    Collects TRAP output and writes it to `stream` (stdout by default) in
+    large chunks. Flushed when the program waits for input, on halt, or once
+    `flush_threshold` characters are pending.
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None, flush_threshold: int = 4096):
+        self.stream = stream
+        self.flush_threshold = flush_threshold
+        self.parts: List[str] = []
+        self.pending = 0
+        # Characters written since creation, flushed or not
+        self.written = 0
+
+    def write(self, text: str) -> None:
+        self.parts.append(text)
+        self.pending += len(text)
+        self.written += len(text)
+        if self.pending >= self.flush_threshold:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.parts:
+            return
+        stream = self.stream or sys.stdout
+        stream.write("".join(self.parts))
+        stream.flush()
+        self.parts.clear()
+        self.pending = 0
+
+
 PC_START: int = 0x3000
 R = Register
 OP = Opcodes
@@ -104,8 +313,6 @@ FL = ConditionFlags
 T = Trapcodes
 MR = MemoryMappedRegisters
 MEM_SIZE = 2**16
-MEM = Memory(MEM_SIZE)
-REG = Registers(R.R_COUNT)
 original_tio = None
 
 
@@ -138,216 +345,1227 @@ def restore_input_buffering():
         termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW, original_tio)
 
 
-def check_key():
-    """
-    Checks if there's input available to read from stdin without blocking.
-    Returns True if there's input ready, False otherwise.
-    """
-    ready, _, _ = select.select([sys.stdin], [], [], 0)
-    return bool(ready)
-
-
 def sign_extend(val: int, bit_count: int) -> int:
     if (val >> (bit_count - 1)) & 1:
         val |= 0xFFFF << bit_count
     return val & 0xFFFF
 
 
-def update_flags(r) -> None:
-    if REG[r] == 0:
-        REG[R.R_COND] = FL.FL_ZRO
-    elif REG[r] >> 15:
-        REG[R.R_COND] = FL.FL_NEG
-    elif REG[r] > 0:
-        REG[R.R_COND] = FL.FL_POS
-    else:
-        raise ValueError(f"Register value {r} is not in one of the buckets")
+def decode(instr: int) -> Decoded:
+    """
+    Extracts the operand fields of an instruction once so the interpreter loop
+    can reuse them every time the instruction runs:
 
+    - ADD/AND: dr, sr1, imm flag, imm5 (sign-extended) or sr2
+    - NOT: dr, sr
+    - BR: nzp mask, PCoffset9
+    - JMP: base_r
+    - JSR: flag (bit 11), base_r, PCoffset11
+    - LD/LDI/LEA/ST/STI: dr/sr, PCoffset9
+    - LDR/STR: dr/sr, base_r, offset6
+    - TRAP: trapvect8
+    """
+    op = instr >> 12
+    a = (instr >> 9) & 7
+    b = (instr >> 6) & 7
+    flag = 0
+    imm = 0
+    if op == OP.OP_ADD or op == OP.OP_AND:
+        flag = (instr >> 5) & 1
+        imm = sign_extend(instr & 0x1F, 5) if flag else instr & 7
+    elif op in (OP.OP_BR, OP.OP_LD, OP.OP_LDI, OP.OP_LEA, OP.OP_ST, OP.OP_STI):
+        imm = sign_extend(instr & 0x1FF, 9)
+    elif op == OP.OP_LDR or op == OP.OP_STR:
+        imm = sign_extend(instr & 0x3F, 6)
+    elif op == OP.OP_JSR:
+        flag = (instr >> 11) & 1
+        imm = sign_extend(instr & 0x7FF, 11)
+    elif op == OP.OP_TRAP:
+        imm = instr & 0xFF
+    return op, a, b, flag, imm
 
-def get_char() -> str:
-    return sys.stdin.read(1).encode("ascii")
 
+# Longest run of instructions translated into a single block
+MAX_BLOCK_LENGTH = 64
 
-def read_image_file(fname: str) -> None:
+
+def translate_block(mem: Memory, regs: array, start: int) -> Optional[Callable]:
+    """
+    Compiles the straight-line run of instructions at `start` into one Python
+    function, with the registers it touches held in locals. The run ends at
+    the first BR/JMP/JSR (which is included) or TRAP (which is left for the
+    interpreter), before the device page, or after MAX_BLOCK_LENGTH
+    instructions.
+
+    The function takes no arguments and returns (executed, step). When step is
+    True, PC points at an instruction the interpreter must run next: a TRAP,
+    or a store that would overwrite translated code. Returns None when there
+    is nothing worth translating at `start`.
+    """
+    body: List[str] = []
+    used = set()
+    written = set()
+    # Expression for COND as of the current instruction; None if no instruction
+    # in the block has set the flags yet
+    cond: Optional[str] = None
+    count = 0
+    addr = start
+
+    def flags_from(r: int) -> str:
+        return f"(2 if r{r} == 0 else 4 if r{r} >> 15 else 1)"
+
+    def exit_code(pc: str, executed: int, step: bool, indent: str = "    ") -> List[str]:
+        lines = [f"{indent}regs[{r}] = r{r}" for r in sorted(written)]
+        if cond is not None:
+            lines.append(f"{indent}regs[{REG_COND}] = {cond}")
+        lines.append(f"{indent}regs[{REG_PC}] = {pc}")
+        lines.append(f"{indent}return {executed}, {step}")
+        return lines
+
+    def load(dst: str, address: str) -> None:
+        if address.isdigit():
+            source = "ram" if int(address) < MMIO_START else "mem"
+            body.append(f"    {dst} = {source}[{address}]")
+        else:
+            body.append(f"    {dst} = ram[{address}] if {address} < {MMIO_START} else mem[{address}]")
+
+    def store(address: str, src: str) -> None:
+        # Let the interpreter perform stores that land on translated code
+        body.append(f"    if code[{address}]:")
+        body.extend(exit_code(str(addr), count - 1, True, indent="        "))
+        body.append(f"    ram[{address}] = {src}")
+        body.append(f"    decoded[{address}] = None")
+
+    terminated = False
+    while count < MAX_BLOCK_LENGTH and addr < MMIO_START:
+        op, a, b, flag, imm = mem.fetch(addr)
+        nxt = (addr + 1) & 0xFFFF
+        if op == OP.OP_TRAP:
+            break
+        count += 1
+        if op == OP.OP_ADD or op == OP.OP_AND:
+            rhs = str(imm) if flag else f"r{imm}"
+            used.update((a, b) if flag else (a, b, imm))
+            if op == OP.OP_ADD:
+                body.append(f"    r{a} = (r{b} + {rhs}) & 0xFFFF")
+            else:
+                body.append(f"    r{a} = r{b} & {rhs}")
+            written.add(a)
+            cond = flags_from(a)
+        elif op == OP.OP_NOT:
+            used.update((a, b))
+            written.add(a)
+            body.append(f"    r{a} = r{b} ^ 0xFFFF")
+            cond = flags_from(a)
+        elif op in (OP.OP_LD, OP.OP_LDI, OP.OP_LDR):
+            used.add(a)
+            written.add(a)
+            if op == OP.OP_LDR:
+                used.add(b)
+                body.append(f"    t = (r{b} + {imm}) & 0xFFFF")
+                load(f"r{a}", "t")
+            elif op == OP.OP_LD:
+                load(f"r{a}", str((nxt + imm) & 0xFFFF))
+            else:
+                load("t", str((nxt + imm) & 0xFFFF))
+                load(f"r{a}", "t")
+            cond = flags_from(a)
+        elif op == OP.OP_LEA:
+            used.add(a)
+            written.add(a)
+            body.append(f"    r{a} = {(nxt + imm) & 0xFFFF}")
+            cond = flags_from(a)
+        elif op in (OP.OP_ST, OP.OP_STI, OP.OP_STR):
+            used.add(a)
+            if op == OP.OP_STR:
+                used.add(b)
+                body.append(f"    t = (r{b} + {imm}) & 0xFFFF")
+            elif op == OP.OP_ST:
+                body.append(f"    t = {(nxt + imm) & 0xFFFF}")
+            else:
+                load("t", str((nxt + imm) & 0xFFFF))
+            store("t", f"r{a}")
+        elif op == OP.OP_BR and a:
+            target = (nxt + imm) & 0xFFFF
+            if a == 7:
+                pc = str(target)
+            elif cond is None:
+                pc = f"{target} if regs[{REG_COND}] & {a} else {nxt}"
+            else:
+                body.append(f"    c = {cond}")
+                cond = "c"
+                pc = f"{target} if c & {a} else {nxt}"
+            body.extend(exit_code(pc, count, False))
+            terminated = True
+        elif op == OP.OP_JMP:
+            used.add(b)
+            body.extend(exit_code(f"r{b}", count, False))
+            terminated = True
+        elif op == OP.OP_JSR:
+            # Flags come from the block so far, before R7 is overwritten
+            if cond is not None:
+                body.append(f"    c = {cond}")
+                cond = "c"
+            used.update((7, b))
+            written.add(7)
+            body.append(f"    r7 = {nxt}")
+            pc = str((nxt + imm) & 0xFFFF) if flag else f"r{b}"
+            body.extend(exit_code(pc, count, False))
+            terminated = True
+        # Anything else (BR never, RTI, RES) does nothing
+        if terminated:
+            break
+        addr = nxt
+
+    if count == 0:
+        return None
+    if not terminated:
+        body.extend(exit_code(str(addr), count, False))
+
+    prologue = [f"    r{r} = regs[{r}]" for r in sorted(used)]
+    src = "\n".join(
+        [f"def block_{start:04x}(regs=regs, ram=ram, mem=mem, decoded=decoded, code=code):"]
+        + prologue
+        + body
+    )
+    namespace = {
+        "regs": regs,
+        "ram": mem.ram,
+        "mem": mem,
+        "decoded": mem.decoded,
+        "code": mem.code,
+    }
+    exec(compile(src, f"<lc3 block x{start:04X}>", "exec"), namespace)
+    fn = namespace[f"block_{start:04x}"]
+    fn.length = count
+    fn.source = src
+    return fn
+
+
+def read_image(fname: str) -> Tuple[int, array]:
+    """
+    Reads an image file into its origin and its words in host byte order
+    """
     with open(fname, "rb") as f:
         origin = int.from_bytes(f.read(2), byteorder="big")
+        p_bytes = f.read()
+    # Images are big-endian; convert the whole payload in one pass
+    words = array("H", p_bytes[: len(p_bytes) & ~1])
+    if sys.byteorder == "little":
+        words.byteswap()
+    if len(p_bytes) & 1:
+        words.append(p_bytes[-1])
+    return origin, words
+
+
+class TraceHash:
+    """
+    A rolling hash over every executed instruction's PC, instruction word and
+    the register file after it ran. Every `interval` instructions the digest
+    so far is appended to `checkpoints` as (instruction count, hex digest), so
+    two runs can be compared, and the first divergence narrowed down to one
+    interval, without keeping the trace itself. Checkpoints are also printed
+    to `file` as they are taken, if one is given.
+    """
+
+    def __init__(self, interval: int = 1_000_000, file: Optional[TextIO] = None):
+        self.interval = interval
+        self.file = file
+        self.count = 0
+        self.checkpoints: List[Tuple[int, str]] = []
+        self._hash = hashlib.blake2b(digest_size=16)
+        self._record = struct.Struct(f"<HH{R.R_COUNT}H").pack
+
+    def update(self, pc: int, instr: int, regs: array) -> None:
+        self._hash.update(self._record(pc, instr, *regs))
+        self.count += 1
+        if self.count % self.interval == 0:
+            self.checkpoint()
 
+    def checkpoint(self) -> None:
+        digest = self._hash.hexdigest()
+        self.checkpoints.append((self.count, digest))
+        if self.file is not None:
+            print(f"{self.count}\t{digest}", file=self.file)
+
+    def finish(self) -> List[Tuple[int, str]]:
+        """
+        Adds a checkpoint for any instructions since the last one and returns
+        all checkpoints
+        """
+        if not self.checkpoints or self.checkpoints[-1][0] != self.count:
+            self.checkpoint()
+        return self.checkpoints
+
+
+def first_divergence(
+    expected: List[Tuple[int, str]], actual: List[Tuple[int, str]]
+) -> Optional[int]:
+    """
+    Returns the instruction count of the first checkpoint where two traces
+    differ (or where the shorter one ends), or None if they agree
+    """
+    for a, b in zip(expected, actual):
+        if a != b:
+            return min(a[0], b[0])
+    if len(expected) != len(actual):
+        shorter = min(expected, actual, key=len)
+        return shorter[-1][0] if shorter else 0
+    return None
+
+
+# Deeper calls are attributed to the frame at this depth
+MAX_PROFILE_DEPTH = 64
+
+
+class Profiler:
+    """
+    Execution counts gathered by LC3VM.run_profiled: per opcode, per PC, per
+    TRAP vector and per call stack (a tuple of JSR targets, outermost first).
+    """
+
+    def __init__(self):
+        self.ops = [0] * 16
+        self.pcs = array("Q", bytes(8 * MEM_SIZE))
+        self.traps: Counter = Counter()
+        self.stacks: Counter = Counter()
+        self.instructions = 0
+        self.input_wait = 0.0
+
+    def report(
+        self, symbols: Optional[Dict[int, str]] = None, top: int = 20, file: TextIO = None
+    ) -> None:
+        """
+        Prints opcode, hot PC and TRAP counts, most frequent first
+        """
+        file = file or sys.stderr
+        symbols = symbols or {}
+        total = self.instructions or 1
+        print(f"instructions: {self.instructions}", file=file)
+        print(f"blocked on input: {self.input_wait:.3f}s", file=file)
+        print("opcodes:", file=file)
+        for op in sorted(range(16), key=lambda op: -self.ops[op]):
+            if self.ops[op]:
+                name = OP(op).name[3:]
+                print(f"  {name:<6}{self.ops[op]:>12}  {100 * self.ops[op] / total:5.1f}%", file=file)
+        print(f"hot spots (top {top}):", file=file)
+        hot = sorted((n, pc) for pc, n in enumerate(self.pcs) if n)[::-1][:top]
+        addresses = sorted(symbols)
+        for n, pc in hot:
+            label = symbol_name(symbols, pc, addresses=addresses)
+            print(f"  x{pc:04X} {label:<24}{n:>12}  {100 * n / total:5.1f}%", file=file)
+        if self.traps:
+            print("traps:", file=file)
+            for vector, n in self.traps.most_common():
+                try:
+                    name = T(vector).name
+                except ValueError:
+                    name = f"x{vector:02X}"
+                print(f"  {name:<12}{n:>12}", file=file)
+
+    def write_folded(self, fname: str, symbols: Optional[Dict[int, str]] = None) -> None:
+        """
+        Writes the call stack counts in the folded format read by flamegraph.pl
+        and speedscope, one `frame;frame;frame count` line per stack
+        """
+        symbols = symbols or {}
+        addresses = sorted(symbols)
+        folded: Counter = Counter()
+        for stack, n in self.stacks.items():
+            frames = [symbol_name(symbols, addr, False, addresses) for addr in stack]
+            folded[";".join(frames)] += n
+        with open(fname, "w") as f:
+            for frames, n in sorted(folded.items()):
+                f.write(f"{frames} {n}\n")
+
+
+def read_symbols(fname: str) -> Dict[int, str]:
+    """
+    Reads a symbol table as written by lc3as, where each entry is a line like
+    `//	LOOP              3004`. Bare `LOOP 3004` lines are accepted too.
+    Returns {address: label}.
+    """
+    symbols = {}
+    with open(fname) as f:
+        for line in f:
+            fields = line.strip().lstrip("/").split()
+            if len(fields) != 2:
+                continue
+            name, address = fields
+            try:
+                symbols[int(address, 16)] = name
+            except ValueError:
+                continue
+    return symbols
+
+
+def symbol_name(
+    symbols: Dict[int, str],
+    address: int,
+    offset: bool = True,
+    addresses: Optional[List[int]] = None,
+) -> str:
+    """
+    Names an address after the closest label at or below it, e.g. `LOOP+2`.
+    Pass `addresses`, the sorted keys of `symbols`, when naming many
+    addresses so they aren't sorted again for each one.
+    """
+    if addresses is None:
+        addresses = sorted(symbols)
+    i = bisect_right(addresses, address)
+    if not i:
+        return f"x{address:04X}"
+    base = addresses[i - 1]
+    if not offset or base == address:
+        return symbols[base]
+    return f"{symbols[base]}+{address - base}"
+
+
+# Snapshot files are this header, the registers, RAM and the pending keys. Words
+# are little-endian so RAM can be read straight into the array on most hosts.
+# Fields: magic, version, register count, halted, instructions, pending keys
+SNAPSHOT_HEADER = struct.Struct("<4sHH?xQI")
+SNAPSHOT_MAGIC = b"LC3S"
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot(NamedTuple):
+    """A copy of everything needed to resume a VM: RAM, registers and unread keys"""
+
+    ram: array
+    registers: array
+    keys: bytes
+    halted: bool
+    instructions: int
+
+
+class LC3VM:
+    """
+    A self-contained LC-3 machine. Owns its memory, registers, keyboard and
+    output, so any number of them can run in one process without a terminal.
+
+        vm = LC3VM(keyboard=Keyboard.from_bytes(b"y"), output=Output(io.StringIO()))
+        vm.load_image("2048.obj")
+        vm.run(max_instructions=1_000_000)
+    """
+
+    def __init__(
+        self,
+        keyboard: Optional[Keyboard] = None,
+        output: Optional[Output] = None,
+        eager_flags: bool = False,
+    ):
+        # Without an input source, reading a key ends the run with EOFError
+        self.keyboard = keyboard if keyboard is not None else Keyboard.from_bytes(b"")
+        self.output = output if output is not None else Output()
+        self.mem = Memory(MEM_SIZE, self.keyboard, self.output)
+        self.reg = Registers(R.R_COUNT)
+        # Direct views of the backing arrays for the opcode handlers
+        self.ram = self.mem.ram
+        self.regs = self.reg.r
+        self.reg[R.R_COND] = FL.FL_ZRO
+        self.reg[R.R_PC] = PC_START
+        # Value last written by a flag-setting instruction. COND is only worked
+        # out from it when BR or a caller needs it; None means regs[R_COND] is current.
+        self.last_result: Optional[int] = None
+        self.halted = False
+        # Instructions executed so far by run()/step()
+        self.instructions = 0
+        # Handlers indexed by opcode (instr >> 12). A handler returns True to halt the VM.
+        self.table = [
+            self.op_br,
+            self.op_add,
+            self.op_ld,
+            self.op_st,
+            self.op_jsr,
+            self.op_and,
+            self.op_ldr,
+            self.op_str,
+            self.op_nop,  # RTI
+            self.op_not,
+            self.op_ldi,
+            self.op_sti,
+            self.op_jmp,
+            self.op_nop,  # RES
+            self.op_lea,
+            self.op_trap,
+        ]
+        self.traps = {
+            T.TRAP_GETC: self.trap_getc,
+            T.TRAP_OUT: self.trap_out,
+            T.TRAP_PUTS: self.trap_puts,
+            T.TRAP_IN: self.trap_getc,
+            T.TRAP_PUTSP: self.trap_putsp,
+            T.TRAP_HALT: self.trap_halt,
+        }
+        if eager_flags:
+            # Verification mode: keep R_COND current after every instruction
+            # like the reference loop does
+            for op in (
+                OP.OP_ADD,
+                OP.OP_AND,
+                OP.OP_NOT,
+                OP.OP_LD,
+                OP.OP_LDI,
+                OP.OP_LDR,
+                OP.OP_LEA,
+                OP.OP_TRAP,
+            ):
+                self.table[op] = self.eager(self.table[op])
+
+    def eager(self, handler: Callable) -> Callable:
+        """
+        Wraps an opcode handler so it updates R_COND as soon as it runs
+        """
+
+        def run_eagerly(a: int, b: int, flag: int, imm: int) -> Optional[bool]:
+            halted = handler(a, b, flag, imm)
+            self.sync_flags()
+            return halted
+
+        return run_eagerly
+
+    def load_image(self, fname: str) -> Tuple[int, int]:
+        """
+        Copies an image into memory at its origin. Returns (origin, size in words).
+        LC-3 source (.asm) is assembled first, or taken from the assembler's cache.
+        """
+        if fname.endswith(".asm"):
+            fname = assembler.build(fname)
+        origin, words = read_image(fname)
         max_read = MEM_SIZE - origin
-        p_bytes = f.read()
-        if len(p_bytes) > max_read:
+        if len(words) > max_read:
             raise ValueError(
-                f"Program is larger than available memory! program_size={p_bytes} memory_size={MEM_SIZE}"
+                f"Program is larger than available memory! program_size={len(words)} memory_size={MEM_SIZE}"
             )
-        for i in range(0, len(p_bytes), 2):
-            slot = int.from_bytes(p_bytes[i : i + 2], byteorder="big")
-            idx = i // 2
-            MEM[origin + idx] = slot
+        self.mem.load(origin, words)
+        return origin, len(words)
 
+    def load_images(self, fnames: List[str]) -> List[Tuple[str, int, int]]:
+        """
+        Loads several images in order, later images overwriting earlier ones.
+        Returns (fname, origin, size) per image and warns on stderr about any
+        images whose address ranges overlap.
+        """
+        loaded = []
+        for fname in fnames:
+            origin, size = self.load_image(fname)
+            for other, other_origin, other_size in loaded:
+                if origin < other_origin + other_size and other_origin < origin + size:
+                    print(
+                        f"Warning: {fname} (x{origin:04X}-x{origin + size - 1:04X}) overlaps "
+                        f"{other} (x{other_origin:04X}-x{other_origin + other_size - 1:04X})",
+                        file=sys.stderr,
+                    )
+            loaded.append((fname, origin, size))
+        return loaded
 
-def main():
-    # Register the interrupt handler for Ctrl+C (SIGINT)
-    signal.signal(signal.SIGINT, handle_interrupt)
+    def snapshot(self) -> Snapshot:
+        self.sync_flags()
+        return Snapshot(
+            ram=array("H", self.mem.ram),
+            registers=array("H", self.reg.r),
+            keys=bytes(self.keyboard.keys),
+            halted=self.halted,
+            instructions=self.instructions,
+        )
 
-    # Register cleanup function to run on program exit
-    atexit.register(restore_input_buffering)
+    def restore(self, snapshot: Snapshot) -> None:
+        self.mem.load(0, snapshot.ram)
+        self.reg.r[:] = snapshot.registers
+        self.last_result = None
+        self.keyboard.keys.clear()
+        self.keyboard.keys.extend(snapshot.keys)
+        self.halted = snapshot.halted
+        self.instructions = snapshot.instructions
 
-    # Configure terminal for raw input
-    disable_input_buffering()
+    def save_snapshot(self, fname: str) -> None:
+        """
+        Writes the machine state to `fname` in the SNAPSHOT_HEADER format
+        """
+        self.sync_flags()
+        regs = self.regs
+        ram = self.ram
+        if sys.byteorder == "big":
+            regs = array("H", regs)
+            regs.byteswap()
+            ram = array("H", ram)
+            ram.byteswap()
+        keys = bytes(self.keyboard.keys)
+        header = SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC,
+            SNAPSHOT_VERSION,
+            len(regs),
+            self.halted,
+            self.instructions,
+            len(keys),
+        )
+        with open(fname, "wb") as f:
+            f.write(header)
+            f.write(regs)
+            f.write(ram)
+            f.write(keys)
 
-    if len(sys.argv) < 2:
-        print("Usage: lc3 [image-file] ...")
-        restore_input_buffering()
-        sys.exit(1)
+    def load_snapshot(self, fname: str) -> None:
+        """
+        Restores state written by save_snapshot, reading RAM and registers
+        directly into their arrays. The snapshot's pending keys are queued
+        ahead of any keys the keyboard already holds.
+        """
+        with open(fname, "rb") as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+            if len(header) != SNAPSHOT_HEADER.size:
+                raise ValueError(f"{fname} is not an LC-3 snapshot")
+            magic, version, reg_count, halted, instructions, key_count = (
+                SNAPSHOT_HEADER.unpack(header)
+            )
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                raise ValueError(f"{fname} is not a version {SNAPSHOT_VERSION} LC-3 snapshot")
+            if reg_count != len(self.regs):
+                raise ValueError(f"{fname} has {reg_count} registers, expected {len(self.regs)}")
+            for buf in (self.regs, self.ram):
+                with memoryview(buf).cast("B") as view:
+                    if f.readinto(view) != len(view):
+                        raise ValueError(f"{fname} is truncated")
+            keys = f.read(key_count)
+        if sys.byteorder == "big":
+            self.regs.byteswap()
+            self.ram.byteswap()
+        self.mem.invalidate(0, len(self.ram))
+        self.last_result = None
+        self.keyboard.keys.extendleft(reversed(keys))
+        self.halted = halted
+        self.instructions = instructions
 
-    for image_file in sys.argv[1:]:
-        read_image_file(image_file)
+    def sync_flags(self) -> None:
+        """
+        Writes the flags for the pending result, if any, to R_COND
+        """
+        result = self.last_result
+        if result is not None:
+            self.regs[REG_COND] = 2 if result == 0 else 4 if result >> 15 else 1
+            self.last_result = None
 
-    REG[R.R_COND] = FL.FL_ZRO
-    REG[R.R_PC] = PC_START
+    def update_flags(self, r) -> None:
+        regs = self.regs
+        val = regs[r]
+        if val == 0:
+            regs[REG_COND] = FL.FL_ZRO
+        elif val >> 15:
+            regs[REG_COND] = FL.FL_NEG
+        else:
+            regs[REG_COND] = FL.FL_POS
 
-    running = True
-    while running:
-        if not (0 <= REG[R.R_PC] < MEM_SIZE):
-            print(f"Error: PC out of bounds: {REG[R.R_PC]:04x}")
-            break
+    def get_char(self) -> bytes:
+        # The program is about to wait on the user, so show it everything printed so far
+        self.output.flush()
+        return bytes([self.keyboard.read()])
 
-        instr: int = MEM[REG[R.R_PC]]
-        op: int = instr >> 12
+    def step(self) -> bool:
+        """
+        Executes a single instruction. Returns True once the VM has halted.
+        """
+        self.run(1)
+        return self.halted
 
-        # print(f"PC={REG[R.R_PC]:04x} INSTR={instr:04x} OP={op:x}")  # Add debug logging
-        # print(REG.r)
+    def run(self, max_instructions: Optional[int] = None) -> int:
+        """
+        Runs the loaded program, dispatching each instruction through the
+        handler table, until it halts or `max_instructions` have executed.
+        Returns the number of instructions executed by this call. InputWait
+        from the keyboard is passed on with PC left on the waiting instruction
+        (the other engines don't support non-blocking keyboards). So is the
+        EOFError of a GETC/IN that runs out of input, in every engine, so a
+        snapshot taken afterwards resumes at that instruction.
+        """
+        if self.halted:
+            return 0
+        fetch = self.mem.fetch
+        regs = self.regs
+        table = self.table
+        limit = -1 if max_instructions is None else max_instructions
+        executed = 0
+        try:
+            while executed != limit:
+                pc = regs[REG_PC]
+                op, a, b, flag, imm = fetch(pc)
+                regs[REG_PC] = (pc + 1) & 0xFFFF
+                executed += 1
+                if table[op](a, b, flag, imm):
+                    self.halted = True
+                    break
+        except (InputWait, EOFError):
+            # Handlers raise before changing any state, so the instruction
+            # can run again from the start once input arrives
+            regs[REG_PC] = pc
+            executed -= 1
+            raise
+        finally:
+            self.instructions += executed
+            self.sync_flags()
+        return executed
 
-        REG[R.R_PC] += 1
+    def run_blocks(self, max_instructions: Optional[int] = None) -> int:
+        """
+        Like run(), but executes translated basic blocks (see translate_block)
+        and only interprets the instructions blocks leave behind. A block is
+        only entered if it fits in the remaining budget, so instruction counts
+        match run() exactly.
+        """
+        if self.halted:
+            return 0
+        mem = self.mem
+        blocks = mem.blocks
+        fetch = mem.fetch
+        regs = self.regs
+        table = self.table
+        limit = -1 if max_instructions is None else max_instructions
+        executed = 0
+        try:
+            while executed != limit:
+                pc = regs[REG_PC]
+                if pc in blocks:
+                    block = blocks[pc]
+                else:
+                    block = blocks[pc] = translate_block(mem, regs, pc)
+                    length = block.length if block is not None else 1
+                    mem.code[pc : pc + length] = b"\x01" * length
+                if block is not None and (limit < 0 or executed + block.length <= limit):
+                    # Blocks read and write R_COND directly
+                    if self.last_result is not None:
+                        self.sync_flags()
+                    n, step = block()
+                    executed += n
+                    if not step or executed == limit:
+                        continue
+                    pc = regs[REG_PC]
+                op, a, b, flag, imm = fetch(pc)
+                regs[REG_PC] = (pc + 1) & 0xFFFF
+                executed += 1
+                if table[op](a, b, flag, imm):
+                    self.halted = True
+                    break
+        except EOFError:
+            # Only TRAPs read keys, and blocks leave those to the interpreter
+            regs[REG_PC] = pc
+            executed -= 1
+            raise
+        finally:
+            self.instructions += executed
+            self.sync_flags()
+        return executed
 
-        if op == OP.OP_ADD:
-            dr = (instr >> 9) & 7
-            sr1 = (instr >> 6) & 7
-            bit_5 = instr >> 5 & 1
-            if bit_5:
-                imm5 = instr & 0x1F
-                imm5 = sign_extend(imm5, 5)
-                REG[dr] = REG[sr1] + imm5
-            else:
-                sr2 = instr & 7
-                REG[dr] = REG[sr1] + REG[sr2]
-            update_flags(dr)
-        elif op == OP.OP_AND:
-            dr = (instr >> 9) & 0b111
-            sr1 = (instr >> 6) & 0b111
-            bit_5 = instr >> 5 & 0b1
-            if bit_5:
-                imm5 = instr & 0b11111
-                imm5 = sign_extend(imm5, 5)
-                REG[dr] = REG[sr1] & imm5
-            else:
-                sr2 = instr & 0b111
-                REG[dr] = REG[sr1] & REG[sr2]
-            REG[dr] = REG[dr]
-            update_flags(dr)
-        elif op == OP.OP_NOT:
-            dr = (instr >> 9) & 7
-            sr = (instr >> 6) & 7
-            complement = REG[sr] ^ 0xFFFF
-            REG[dr] = complement
-            update_flags(dr)
-        elif op == OP.OP_BR:
-            n = instr >> 11 & 1
-            z = instr >> 10 & 1
-            p = instr >> 9 & 1
-            conditions = [
-                n and REG[R.R_COND] == FL.FL_NEG,
-                z and REG[R.R_COND] == FL.FL_ZRO,
-                p and REG[R.R_COND] == FL.FL_POS,
-            ]
-            if any(conditions):
-                offset = sign_extend(instr & 0x1FF, 9)
-                REG[R.R_PC] = REG[R.R_PC] + offset
-        elif op == OP.OP_JMP:
-            base_r = (instr >> 6) & 7
-            REG[R.R_PC] = REG[base_r]
-        elif op == OP.OP_JSR:
-            bit_11 = instr >> 11 & 1
-            REG[R.R_R7] = REG[R.R_PC]
-            if bit_11:
-                offset = instr & 0x7FF
-                REG[R.R_PC] += sign_extend(offset, 11)
-            else:
-                base_r = (instr >> 6) & 7
-                REG[R.R_PC] = REG[base_r]
-        elif op == OP.OP_LD:
-            dr = instr >> 9 & 7
-            offset = sign_extend(instr & 0x1FF, 9)
-            REG[dr] = MEM[REG[R.R_PC] + offset]
-            update_flags(dr)
-        elif op == OP.OP_LDI:
-            dr = (instr >> 9) & 0b111
-            pc_offset = sign_extend(instr & 0x1FF, 9)
-            value = MEM[MEM[REG[R.R_PC] + pc_offset]]
-            REG[dr] = value
-            update_flags(dr)
-        elif op == OP.OP_LDR:
-            dr = (instr >> 9) & 7
-            base_r = (instr >> 6) & 7
-            offset = sign_extend(instr & 0x3F, 6)
-            REG[dr] = MEM[REG[base_r] + offset]
-            update_flags(dr)
-        elif op == OP.OP_LEA:
-            dr = (instr >> 9) & 7
-            offset = sign_extend(instr & 0x1FF, 9)
-            REG[dr] = REG[R.R_PC] + offset
-            update_flags(dr)
-        elif op == OP.OP_ST:
-            sr = (instr >> 9) & 7
-            offset = sign_extend(instr & 0x1FF, 9)
-            MEM[REG[R.R_PC] + offset] = REG[sr]
-        elif op == OP.OP_STI:
-            sr = (instr >> 9) & 7
-            offset = sign_extend(instr & 0x1FF, 9)
-            MEM[MEM[REG[R.R_PC] + offset]] = REG[sr]
-        elif op == OP.OP_STR:
-            sr = (instr >> 9) & 7
-            base_r = (instr >> 6) & 7
-            offset = sign_extend(instr & 0x3F, 6)
-            MEM[REG[base_r] + offset] = REG[sr]
-        elif op == OP.OP_TRAP:
-            REG[R.R_R7] = REG[R.R_PC]
-            t_code = instr & 0xFF
-            if t_code == T.TRAP_GETC:
-                char = get_char()
-                REG[R.R_R0] = 0
-                REG[R.R_R0] = ord(char)
-                update_flags(R.R_R0)
-            elif t_code == T.TRAP_OUT:
-                char = chr(REG[R.R_R0] & 0xFF)
-                print(char, end="", flush=True)
-            elif t_code == T.TRAP_PUTS:
-                pt = REG[R.R_R0]
-                while MEM[pt]:
-                    print(chr(MEM[pt]), end="", flush=True)
-                    pt += 1
-            elif t_code == T.TRAP_IN:
-                char = get_char()
-                REG[R.R_R0] = 0
-                REG[R.R_R0] = ord(char)
-                update_flags(R.R_R0)
-            elif t_code == T.TRAP_PUTSP:
-                start = REG[R.R_R0]
-                while MEM[start]:
-                    left = MEM[start] >> 8
-                    right = MEM[start] & 0xFF
-                    print(chr(left), end="", flush=True)
-                    if right:
-                        print(chr(right), end="")
-                    start += 1
-            elif t_code == T.TRAP_HALT:
-                print("HALT!")
-                running = False
+    def run_profiled(
+        self, profiler: Profiler, max_instructions: Optional[int] = None
+    ) -> int:
+        """
+        Like run(), but records what runs into `profiler`. JSR/JSRR pushes a
+        call frame and a JMP to a pending return address pops back to the
+        caller. Calling a routine that is already on the stack unwinds to it
+        first, so recursion and routines that never return don't grow the
+        stack. TRAP routines don't count as calls since they run in Python.
+        """
+        if self.halted:
+            return 0
+        fetch = self.mem.fetch
+        regs = self.regs
+        table = self.table
+        ops = profiler.ops
+        pcs = profiler.pcs
+        traps = profiler.traps
+        stacks = profiler.stacks
+        stack: Tuple[int, ...] = (regs[REG_PC],)
+        # Return address of each call in `stack`
+        returns: List[int] = []
+        limit = -1 if max_instructions is None else max_instructions
+        executed = 0
+        wait_start = self.keyboard.wait_time
+        try:
+            while executed != limit:
+                pc = regs[REG_PC]
+                op, a, b, flag, imm = fetch(pc)
+                ops[op] += 1
+                pcs[pc] += 1
+                stacks[stack] += 1
+                regs[REG_PC] = (pc + 1) & 0xFFFF
+                executed += 1
+                if op == OP_TRAP:
+                    traps[imm] += 1
+                halted = table[op](a, b, flag, imm)
+                if op == OP_JSR:
+                    callee = regs[REG_PC]
+                    if callee in stack[1:]:
+                        depth = stack.index(callee, 1) - 1
+                        del returns[depth:]
+                        stack = stack[: depth + 1]
+                    if len(returns) < MAX_PROFILE_DEPTH:
+                        stack = stack + (callee,)
+                        returns.append(regs[REG_R7])
+                elif op == OP_JMP and regs[REG_PC] in returns:
+                    depth = len(returns) - returns[::-1].index(regs[REG_PC]) - 1
+                    del returns[depth:]
+                    stack = stack[: depth + 1]
+                if halted:
+                    self.halted = True
+                    break
+        except EOFError:
+            # Take back the GETC/IN that found no key, as run() does
+            regs[REG_PC] = pc
+            executed -= 1
+            ops[op] -= 1
+            pcs[pc] -= 1
+            # Counters only list what ran, so drop entries that fall to zero
+            for counts, key in ((stacks, stack), (traps, imm)):
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+            raise
+        finally:
+            self.instructions += executed
+            self.sync_flags()
+            profiler.instructions += executed
+            profiler.input_wait += self.keyboard.wait_time - wait_start
+        return executed
+
+    def run_traced(self, trace: "TraceHash", max_instructions: Optional[int] = None) -> int:
+        """
+        Like run(), but feeds every executed instruction to `trace`. The
+        condition codes are brought up to date first so that the traced
+        register file matches the reference engine's.
+        """
+        if self.halted:
+            return 0
+        fetch = self.mem.fetch
+        ram = self.ram
+        regs = self.regs
+        table = self.table
+        update = trace.update
+        limit = -1 if max_instructions is None else max_instructions
+        executed = 0
+        try:
+            while executed != limit:
+                pc = regs[REG_PC]
+                instr = ram[pc]
+                op, a, b, flag, imm = fetch(pc)
+                regs[REG_PC] = (pc + 1) & 0xFFFF
+                executed += 1
+                halted = table[op](a, b, flag, imm)
+                self.sync_flags()
+                update(pc, instr, regs)
+                if halted:
+                    self.halted = True
+                    break
+        except EOFError:
+            # Take back the GETC/IN that found no key, as run() does
+            regs[REG_PC] = pc
+            executed -= 1
+            raise
+        finally:
+            self.instructions += executed
+            self.sync_flags()
+        return executed
+
+    def run_reference(
+        self, max_instructions: Optional[int] = None, trace: Optional["TraceHash"] = None
+    ) -> int:
+        """
+        Runs the loaded program with the original if/elif opcode chain. Kept as a
+        reference to check the table-driven engine in run() against. Stops after
+        `max_instructions` like run(), and feeds each executed instruction to
+        `trace` if one is given. Returns the number of instructions executed.
+        """
+        if self.halted:
+            return 0
+        mem = self.mem
+        reg = self.reg
+        output = self.output
+        self.sync_flags()
+        limit = -1 if max_instructions is None else max_instructions
+        executed = 0
+        running = True
+        while running and executed != limit:
+            if not (0 <= reg[R.R_PC] < MEM_SIZE):
+                print(f"Error: PC out of bounds: {reg[R.R_PC]:04x}", file=sys.stderr)
+                break
+
+            pc = reg[R.R_PC]
+            instr = mem.ram[pc]
+            op, a, b, flag, imm = mem.fetch(pc)
+
+            # print(f"PC={reg[R.R_PC]:04x} INSTR={mem.ram[reg[R.R_PC]]:04x} OP={op:x}")  # Add debug logging
+            # print(reg.r)
+
+            reg[R.R_PC] += 1
+
+            if op == OP.OP_ADD:
+                if flag:
+                    reg[a] = reg[b] + imm
+                else:
+                    reg[a] = reg[b] + reg[imm]
+                self.update_flags(a)
+            elif op == OP.OP_AND:
+                if flag:
+                    reg[a] = reg[b] & imm
+                else:
+                    reg[a] = reg[b] & reg[imm]
+                self.update_flags(a)
+            elif op == OP.OP_NOT:
+                reg[a] = reg[b] ^ 0xFFFF
+                self.update_flags(a)
+            elif op == OP.OP_BR:
+                # nzp lines up with FL_NEG/FL_ZRO/FL_POS, so one mask test covers all three
+                if a & reg[R.R_COND]:
+                    reg[R.R_PC] = reg[R.R_PC] + imm
+            elif op == OP.OP_JMP:
+                reg[R.R_PC] = reg[b]
+            elif op == OP.OP_JSR:
+                reg[R.R_R7] = reg[R.R_PC]
+                if flag:
+                    reg[R.R_PC] += imm
+                else:
+                    reg[R.R_PC] = reg[b]
+            elif op == OP.OP_LD:
+                reg[a] = mem[reg[R.R_PC] + imm]
+                self.update_flags(a)
+            elif op == OP.OP_LDI:
+                reg[a] = mem[mem[reg[R.R_PC] + imm]]
+                self.update_flags(a)
+            elif op == OP.OP_LDR:
+                reg[a] = mem[reg[b] + imm]
+                self.update_flags(a)
+            elif op == OP.OP_LEA:
+                reg[a] = reg[R.R_PC] + imm
+                self.update_flags(a)
+            elif op == OP.OP_ST:
+                mem[reg[R.R_PC] + imm] = reg[a]
+            elif op == OP.OP_STI:
+                mem[mem[reg[R.R_PC] + imm]] = reg[a]
+            elif op == OP.OP_STR:
+                mem[reg[b] + imm] = reg[a]
+            elif op == OP.OP_TRAP:
+                t_code = imm
+                if t_code == T.TRAP_GETC or t_code == T.TRAP_IN:
+                    try:
+                        char = self.get_char()
+                    except EOFError:
+                        # Leave PC on the GETC/IN that found no key, as run() does
+                        reg[R.R_PC] = pc
+                        raise
+                reg[R.R_R7] = reg[R.R_PC]
+                if t_code == T.TRAP_GETC:
+                    reg[R.R_R0] = 0
+                    reg[R.R_R0] = ord(char)
+                    self.update_flags(R.R_R0)
+                elif t_code == T.TRAP_OUT:
+                    char = chr(reg[R.R_R0] & 0xFF)
+                    output.write(char)
+                elif t_code == T.TRAP_PUTS:
+                    pt = reg[R.R_R0]
+                    while mem[pt]:
+                        output.write(chr(mem[pt]))
+                        pt += 1
+                elif t_code == T.TRAP_IN:
+                    reg[R.R_R0] = 0
+                    reg[R.R_R0] = ord(char)
+                    self.update_flags(R.R_R0)
+                elif t_code == T.TRAP_PUTSP:
+                    start = reg[R.R_R0]
+                    while mem[start]:
+                        left = mem[start] >> 8
+                        right = mem[start] & 0xFF
+                        output.write(chr(left))
+                        if right:
+                            output.write(chr(right))
+                        start += 1
+                elif t_code == T.TRAP_HALT:
+                    output.write("HALT!\n")
+                    output.flush()
+                    self.halted = True
+                    running = False
+                else:
+                    output.write("WTF\n")
+            elif op == OP.OP_RES or op == OP.OP_RTI:
+                pass
             else:
-                print("WTF")
-        elif op == OP.OP_RES or op == OP.OP_RTI:
-            pass
+                pass
+
+            executed += 1
+            self.instructions += 1
+            if trace is not None:
+                trace.update(pc, instr, reg.r)
+        return executed
+
+    def op_add(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        if flag:
+            regs[a] = self.last_result = (regs[b] + imm) & 0xFFFF
+        else:
+            regs[a] = self.last_result = (regs[b] + regs[imm]) & 0xFFFF
+
+    def op_and(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        if flag:
+            regs[a] = self.last_result = regs[b] & imm
+        else:
+            regs[a] = self.last_result = regs[b] & regs[imm]
+
+    def op_not(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        regs[a] = self.last_result = regs[b] ^ 0xFFFF
+
+    def op_br(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        result = self.last_result
+        if result is None:
+            cond = regs[REG_COND]
+        else:
+            cond = 2 if result == 0 else 4 if result >> 15 else 1
+        if a & cond:
+            regs[REG_PC] = (regs[REG_PC] + imm) & 0xFFFF
+
+    def op_jmp(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        regs[REG_PC] = regs[b]
+
+    def op_jsr(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        regs[REG_R7] = regs[REG_PC]
+        if flag:
+            regs[REG_PC] = (regs[REG_PC] + imm) & 0xFFFF
         else:
-            pass
+            regs[REG_PC] = regs[b]
+
+    def op_ld(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        mem = self.mem
+        address = (regs[REG_PC] + imm) & 0xFFFF
+        regs[a] = self.last_result = self.ram[address] if address < MMIO_START else mem[address]
+
+    def op_ldi(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        mem = self.mem
+        address = mem[regs[REG_PC] + imm]
+        regs[a] = self.last_result = self.ram[address] if address < MMIO_START else mem[address]
+
+    def op_ldr(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        mem = self.mem
+        address = (regs[b] + imm) & 0xFFFF
+        regs[a] = self.last_result = self.ram[address] if address < MMIO_START else mem[address]
+
+    def op_lea(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        regs[a] = self.last_result = (regs[REG_PC] + imm) & 0xFFFF
+
+    def op_st(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        self.mem[regs[REG_PC] + imm] = regs[a]
+
+    def op_sti(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        mem = self.mem
+        mem[mem[regs[REG_PC] + imm]] = regs[a]
+
+    def op_str(self, a: int, b: int, flag: int, imm: int) -> None:
+        regs = self.regs
+        self.mem[regs[b] + imm] = regs[a]
+
+    def op_nop(self, a: int, b: int, flag: int, imm: int) -> None:
+        pass
+
+    def op_trap(self, a: int, b: int, flag: int, imm: int) -> Optional[bool]:
+        regs = self.regs
+        trap = self.traps.get(imm)
+        if trap is None:
+            regs[REG_R7] = regs[REG_PC]
+            self.output.write("WTF\n")
+            return None
+        # R7 is set after the routine, which doesn't read it, so that a GETC
+        # that raises for want of a key leaves the registers untouched
+        halted = trap()
+        regs[REG_R7] = regs[REG_PC]
+        return halted
+
+    def trap_getc(self) -> None:
+        self.reg[R.R_R0] = self.last_result = ord(self.get_char())
+
+    def trap_out(self) -> None:
+        self.output.write(chr(self.reg.r[REG_R0] & 0xFF))
+
+    def read_string(self, start: int) -> List[int]:
+        """
+        Returns the words from `start` up to (not including) the next 0 word
+        """
+        mem = self.mem
+        ram = mem.ram
+        try:
+            # Strings that stay below the device page can be sliced straight out of RAM
+            return ram[start : ram.index(0, start, MMIO_START)].tolist()
+        except ValueError:
+            words = []
+            while mem[start]:
+                words.append(mem[start])
+                start += 1
+            return words
+
+    def trap_puts(self) -> None:
+        self.output.write("".join(map(chr, self.read_string(self.reg.r[REG_R0]))))
+
+    def trap_putsp(self) -> None:
+        chars = []
+        for word in self.read_string(self.reg.r[REG_R0]):
+            chars.append(chr(word >> 8))
+            if word & 0xFF:
+                chars.append(chr(word & 0xFF))
+        self.output.write("".join(chars))
+
+    def trap_halt(self) -> bool:
+        self.output.write("HALT!\n")
+        self.output.flush()
+        return True
+
+
+def main():
+    if sys.argv[1:2] == ["batch"]:
+        import batch
+
+        batch.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["bench"]:
+        import bench
+
+        bench.main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        import server
+
+        server.main(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(prog="lc3")
+    parser.add_argument("images", nargs="*", metavar="image-file")
+    parser.add_argument(
+        "--engine",
+        choices=["table", "blocks", "reference"],
+        default="table",
+        help="blocks runs translated basic blocks; reference runs the original if/elif interpreter loop",
+    )
+    parser.add_argument(
+        "--input",
+        metavar="FILE",
+        help="replay key presses from FILE instead of reading the terminal",
+    )
+    parser.add_argument(
+        "--output-buffer",
+        type=int,
+        default=4096,
+        metavar="CHARS",
+        help="flush program output once this many characters are pending",
+    )
+    parser.add_argument(
+        "--trace-hash",
+        type=int,
+        metavar="N",
+        help="print a rolling hash of PC, instruction and registers to stderr every N instructions",
+    )
+    parser.add_argument(
+        "--eager-flags",
+        action="store_true",
+        help="update the condition codes after every instruction (for verification)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="count executions per opcode, PC and TRAP and print a report on exit",
+    )
+    parser.add_argument(
+        "--profile-folded",
+        metavar="FILE",
+        help="with --profile, also write call stacks for flamegraph.pl to FILE",
+    )
+    parser.add_argument(
+        "--symbols",
+        metavar="FILE",
+        action="append",
+        default=[],
+        help="lc3as .sym file used to label profile output (repeatable)",
+    )
+    parser.add_argument(
+        "--max-instructions",
+        type=int,
+        metavar="N",
+        help="stop after N instructions instead of waiting for HALT",
+    )
+    parser.add_argument(
+        "--restore",
+        metavar="FILE",
+        help="start from a snapshot written by --save-snapshot (images load on top)",
+    )
+    parser.add_argument(
+        "--save-snapshot",
+        metavar="FILE",
+        help="write the machine state to FILE when the run stops",
+    )
+    args = parser.parse_args()
+    if not args.images and not args.restore:
+        parser.error("an image file or --restore is required")
+    if args.trace_hash is not None and (args.profile or args.engine == "blocks"):
+        parser.error("--trace-hash needs the table or reference engine without --profile")
+
+    if args.input:
+        keyboard = Keyboard.from_file(args.input)
+    else:
+        # Register the interrupt handler for Ctrl+C (SIGINT)
+        signal.signal(signal.SIGINT, handle_interrupt)
+
+        # Register cleanup function to run on program exit
+        atexit.register(restore_input_buffering)
+
+        # Configure terminal for raw input
+        disable_input_buffering()
+        keyboard = Keyboard.from_fd(sys.stdin.fileno())
+
+    vm = LC3VM(
+        keyboard, Output(flush_threshold=args.output_buffer), eager_flags=args.eager_flags
+    )
+    # Show whatever the program printed if it is interrupted
+    atexit.register(vm.output.flush)
+    if args.restore:
+        vm.load_snapshot(args.restore)
+    vm.load_images(args.images)
+
+    profiler = Profiler() if args.profile else None
+    trace = None
+    if args.trace_hash is not None:
+        trace = TraceHash(args.trace_hash, file=sys.stderr)
+    try:
+        if profiler is not None:
+            vm.run_profiled(profiler, args.max_instructions)
+        elif args.engine == "reference":
+            vm.run_reference(args.max_instructions, trace)
+        elif trace is not None:
+            vm.run_traced(trace, args.max_instructions)
+        elif args.engine == "blocks":
+            vm.run_blocks(args.max_instructions)
+        else:
+            vm.run(args.max_instructions)
+    except EOFError as e:
+        vm.output.flush()
+        print(f"\nError: {e}", file=sys.stderr)
+    vm.output.flush()
+    if trace is not None:
+        trace.finish()
+
+    if args.save_snapshot:
+        vm.save_snapshot(args.save_snapshot)
+
+    if profiler is not None:
+        symbols = {}
+        for fname in args.symbols:
+            symbols.update(read_symbols(fname))
+        profiler.report(symbols)
+        if args.profile_folded:
+            profiler.write_folded(args.profile_folded, symbols)
 
     restore_input_buffering()
 